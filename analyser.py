@@ -2,97 +2,272 @@ from misc import ManoAnalyserError
 from objs import *
 
 
-lookup = {}
+WORD  = ('var', Type('WORD'))
+VAR   = ('var', 'any')
+LABEL = ('label', 'any')
+KINDS = {'var': 'variable', 'label': 'label', 'function': 'function'}
 
 
 def analyse_program(functionset):
-  global lookup
+  Analyser().analyse_program(functionset)
 
-  if not isinstance(functionset, dict):
-    raise ManoAnalyserError('Input program is not a dictionary of functions.')
 
-  # Construct function lookup table.
-  global_lookup = {}
-  for funcname in functionset:
-    global_lookup[funcname] = ('function', functionset[funcname].return_type)
+def analyse_stream(functions, signatures):
+  return Analyser().analyse_stream(functions, signatures)
 
-  for funcname in functionset:
-    func = functionset[funcname]
 
-    # Construct var lookup table.
-    lookup = {}
-    lookup.update(global_lookup)
+def check_program(functionset):
+  return Analyser(collect=True).analyse_program(functionset)
 
-    varnames = func.vars.keys()
-    for varname in varnames:
-      lookup[varname] = ('var', func.vars[varname][0])
 
-    # Construct label lookup table.
+def call_graph(functionset):
+  # The names of the functions each function calls.
+  calls = {}
+  for funcname, func in functionset.items():
+    calls[funcname] = set(line.expression.function for line in func.code
+                          if isinstance(line, AssignLine) and
+                             isinstance(line.expression, Call))
+  return calls
+
+
+def find_recursive(calls):
+  # Functions in a cycle of the call graph, that is, those that may be called
+  # again before they return. Tarjan's algorithm, without recursion. Calls to
+  # functions missing from the graph are ignored.
+  index = {}
+  low = {}
+  stack = []
+  onstack = set()
+  recursive = set()
+
+  for root in calls:
+    if root in index:
+      continue
+
+    index[root] = low[root] = len(index)
+    stack.append(root)
+    onstack.add(root)
+    work = [(root, iter(calls[root]))]
+
+    while work:
+      (node, callees) = work[-1]
+      for callee in callees:
+        if callee not in calls:
+          continue
+        if callee not in index:
+          index[callee] = low[callee] = len(index)
+          stack.append(callee)
+          onstack.add(callee)
+          work.append((callee, iter(calls[callee])))
+          break
+        if callee in onstack:
+          low[node] = min(low[node], index[callee])
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          low[parent] = min(low[parent], low[node])
+
+        if low[node] == index[node]:
+          component = []
+          while True:
+            member = stack.pop()
+            onstack.discard(member)
+            component.append(member)
+            if member == node:
+              break
+
+          if len(component) > 1 or node in calls[node]:
+            recursive.update(component)
+
+  return recursive
+
+
+def reachable(calls, root='main'):
+  # Functions that may be called, directly or not, from root, and root itself.
+  seen = set([root])
+  work = [root]
+  while work:
+    for callee in calls.get(work.pop(), ()):
+      if callee not in seen:
+        seen.add(callee)
+        work.append(callee)
+
+  return seen
+
+
+def direct_functions(calls):
+  # Functions that callers may pass arguments to in their parameters and jump
+  # to directly, instead of through the stack. main is always called through
+  # the stack.
+  recursive = find_recursive(calls)
+  return set(i for i in calls if i != 'main' and i not in recursive)
+
+
+class Analyser(object):
+  # Names are resolved in two tables: the program-wide table of functions,
+  # built once by build_global_lookup and shared by all functions, and a table
+  # of the variables and labels of the function being analysed, which shadows
+  # it. With collect set, errors are gathered in self.errors instead of
+  # stopping the analysis at the first one.
+  def __init__(self, collect=False):
+    self.globals = {}
+    self.locals = {}
+    self.constants = {}
+    self.funcname = None
+    self.errors = [] if collect else None
+
+  def analyse_program(self, functionset):
+    if not isinstance(functionset, dict):
+      raise ManoAnalyserError('Input program is not a dictionary of functions.')
+
+    signatures = {}
+    for funcname in functionset:
+      signatures[funcname] = functionset[funcname].signature()
+
+    global_lookup = self.build_global_lookup(signatures)
+    for funcname in functionset:
+      self.analyse_function(
+          funcname, functionset[funcname], signatures, global_lookup)
+
+    if self.errors is not None:
+      self.errors.sort(key=lambda e: e.line)
+    return self.errors
+
+  def analyse_stream(self, functions, signatures):
+    global_lookup = self.build_global_lookup(signatures)
+    for funcname, func in functions:
+      self.analyse_function(funcname, func, signatures, global_lookup)
+      yield funcname, func
+
+  def build_global_lookup(self, signatures):
+    # Construct function lookup table.
+    global_lookup = {}
+    for funcname in signatures:
+      global_lookup[funcname] = ('function', signatures[funcname][0])
+
+    return global_lookup
+
+  def analyse_function(self, funcname, func, signatures, global_lookup):
+    self.funcname = funcname
+    self.globals = global_lookup
+
+    # Construct var and label lookup table.
+    self.locals = {}
+    self.constants = {}
+    for varname in func.vars:
+      (typ, value) = func.vars[varname]
+      self.locals[varname] = ('var', typ)
+      if value is not None and typ.name == 'WORD':
+        self.constants[varname] = value
+
     for line in func.code:
       if line.label:
-        lookup[line.label] = ('label', 'any')
+        self.locals[line.label] = LABEL
 
     # Analyse code.
     for line in func.code:
+      self.assertType(line.condition, VAR, line)
       if isinstance(line, GotoLine):
-        assertType(line.target, ('label', 'any'), line, funcname, func)
-      elif isinstance(line, PrintLine):
-        assertType(line.target, ('var', 'any'), line, funcname, func)
-      elif isinstance(line, ReadLine):
-        assertType(line.target, ('var', 'any'), line, funcname, func)
+        self.assertType(line.target, LABEL, line)
+      elif isinstance(line, (PrintLine, ReadLine)):
+        self.assertType(line.target, VAR, line)
       elif isinstance(line, ReturnLine):
-        if line.target != 'null':
-          assertType(
-              line.target, ('var', lookup[funcname][1]), line, funcname, func)
+        if line.target is not None and line.target != 'null':
+          rettype = self.globals[funcname][1]
+          if rettype is None:
+            self.error(line, 'Function %s has no return type.' % funcname)
+          else:
+            self.assertType(line.target, ('var', rettype), line)
       elif isinstance(line, AssignLine):
-        type = getType(line.expression, functionset, line, funcname, func)
-        if line.index:
-          if type != ('var', Type('WORD')):
-            throwError(line, funcname, func)
-        elif line.target:
-          assertType(line.target, type, line, funcname, func)
+        typ = self.getType(line.expression, signatures, line)
+        if typ is None or line.target is None:
+          continue
+
+        if typ[1] is None:
+          self.error(line, 'Function %s returns no value.' %
+                           line.expression.function)
+        elif line.index:
+          self.assertIndexed(line.target, line.index, line)
+          if typ != WORD:
+            self.error(line, 'Array element assigned a value of type %s.' %
+                             typ[1])
+        else:
+          self.assertType(line.target, typ, line)
       else:
         raise ManoAnalyserError, 'Unrecognize statement type encountered.'
 
+    self.locals = {}
+    self.constants = {}
+    self.funcname = None
 
-def assertType(identifier, typ, line, funcname, func):
-  if identifier is None: return
-  try:
-    if typ[1] == 'any':
-      if lookup[identifier][0] != typ[0]:
-        throwError(line, funcname, func)
-    else:
-      if lookup[identifier] != typ:
-        throwError(line, funcname, func)
-  except:
-    throwError(line, funcname, func)
+  def lookup(self, name):
+    entry = self.locals.get(name)
+    if entry is None:
+      entry = self.globals.get(name)
+    return entry
+
+  def assertType(self, identifier, typ, line):
+    if identifier is None:
+      return True
+
+    entry = self.lookup(identifier)
+    if entry is None:
+      return self.error(line, 'Undefined identifier %s.' % identifier)
+    if entry[0] != typ[0]:
+      return self.error(line, '%s is a %s, expected a %s.' %
+                              (identifier, KINDS[entry[0]], KINDS[typ[0]]))
+    if typ[1] != 'any' and entry[1] != typ[1]:
+      return self.error(line, '%s has type %s, expected %s.' %
+                              (identifier, entry[1], typ[1]))
+    return True
+
+  def assertIndexed(self, name, index, line):
+    if self.assertType(name, VAR, line):
+      typ = self.lookup(name)[1]
+      if typ.name == 'WORD':
+        self.error(line, '%s has type WORD and cannot be indexed.' % name)
+      elif index in self.constants and \
+           not 0 <= self.constants[index] < typ.size:
+        self.error(line, 'Index %d out of bounds for %s of size %d.' %
+                         (self.constants[index], name, typ.size))
+    self.assertType(index, WORD, line)
+
+  def error(self, line, msg):
+    error = ManoAnalyserError(msg, line.lineno, self.funcname, line)
+    if self.errors is None:
+      raise error
+    self.errors.append(error)
+    return False
 
+  def getType(self, exp, signatures, line):
+    # Returns None if the expression has a type error.
+    if isinstance(exp, Identifier):
+      if exp.index is not None:
+        self.assertIndexed(exp.name, exp.index, line)
+        return WORD
+      elif self.assertType(exp.name, VAR, line):
+        return self.lookup(exp.name)
+    elif isinstance(exp, UnaryOperation):
+      self.assertType(exp.operand, WORD, line)
+      return WORD
+    elif isinstance(exp, BinaryOperation):
+      self.assertType(exp.left, WORD, line)
+      self.assertType(exp.right, WORD, line)
+      return WORD
+    elif isinstance(exp, Call):
+      if exp.function not in signatures:
+        self.error(line, 'Call to undefined function %s.' % exp.function)
+        return None
 
-def throwError(line, funcname, func):
-  details = (func.code.index(line)+1, funcname, line)
-  raise ManoAnalyserError('Error in statement %d of function %s: %s.' % details)
+      (rettype, params) = signatures[exp.function]
+      if len(exp.arguments) != len(params):
+        self.error(line, 'Function %s takes %d arguments, %d given.' %
+                         (exp.function, len(params), len(exp.arguments)))
 
+      for argument, typ in zip(exp.arguments, params):
+        self.assertType(argument, ('var', typ), line)
 
-def getType(exp, functionset, line, funcname, func):
-  if isinstance(exp, Identifier):
-    if exp.index is not None:
-      return ('var', Type('WORD'))
+      return ('var', rettype)
     else:
-      return lookup[exp.name]
-  elif isinstance(exp, UnaryOperation):
-    assertType(exp.operand, ('var', Type('WORD')), line, funcname, func)
-    return ('var', Type('WORD'))
-  elif isinstance(exp, BinaryOperation):
-    assertType(exp.left, ('var', Type('WORD')), line, funcname, func)
-    assertType(exp.right, ('var', Type('WORD')), line, funcname, func)
-    return ('var', Type('WORD'))
-  elif isinstance(exp, Call):
-    target_func = functionset[exp.function]
-
-    for i in range(len(exp.arguments)):
-      typ = ('var', target_func.vars[target_func.params[i]][0])
-      assertType(exp.arguments[i], typ, line, funcname, func)
-
-    return ('var', lookup[exp.function][1])
-  else:
-    raise ManoAnalyserError('Unrecognize expression type encountered.')
+      raise ManoAnalyserError('Unrecognize expression type encountered.')
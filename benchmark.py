@@ -0,0 +1,465 @@
+#!/usr/bin/python2
+
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tokenize
+from multiprocessing.pool import ThreadPool
+import analyser
+import collapser
+import compiler
+import generator
+import interpreter
+import misc
+import mparser
+import objs
+import runtime
+import simulator
+
+
+EXAMPLE = 'resources/example.txt'
+ARITH = 'resources/arith.txt'
+RE_FUNCNAME = re.compile(r'\b(main|min|max|sum|fib|find|insertion_sort)\b')
+
+
+class legacy_tokenizer(object):
+  # The original tokenize-based implementation of misc.tokenizer, kept as a
+  # baseline for the lexer benchmark.
+  def __init__(self, text):
+    self.finished = False
+    self._curline = 1
+    self._gen = tokenize.generate_tokens(self._lines(text).next)
+    self._line = []
+
+    self._endnext = False
+    self._nextline= []
+
+    self.peek()
+
+  def _lines(self, text):
+    start = 0
+
+    for i in xrange(len(text)):
+      if text[i] == '\n':
+        if text[start:i] and not text[start:i].isspace(): yield text[start:i]
+        start = i+1
+
+    yield text[start:]
+
+  def read(self):
+    line = self._nextline
+    self._nextline = []
+
+    self.peek()
+    if self._endnext:
+      self.finished = True
+
+    return line
+
+  def peek(self):
+    if self._nextline:
+      return self._nextline
+
+    if self.finished:
+      raise misc.ManoParserError('No lines remaining.')
+
+    for i in self._gen:
+      if self._curline != i[2][0]:
+        self._curline += 1
+        line = self._line
+
+        if i[1] and not i[1].isspace():
+          self._line = [i[1]]
+        else:
+          self._line = []
+
+        self._nextline = line
+
+        return line
+
+      if i[1] and not i[1].isspace(): self._line.append(i[1])
+
+    self._endnext = True
+
+  def __nonzero__(self):
+    return not self.finished
+
+
+class legacy_node(object):
+  # A dict-backed object, as the AST nodes, types and AsmLines were before they
+  # got __slots__, kept as a baseline for the memory benchmark.
+  pass
+
+
+def legacy_copy(obj, memo):
+  # Copies the slotted objects reachable from obj into legacy_nodes. Types
+  # are copied at every use, as they were built afresh before being interned.
+  if isinstance(obj, dict):
+    return dict((legacy_copy(k, memo), legacy_copy(v, memo))
+                for k, v in obj.iteritems())
+  elif isinstance(obj, list):
+    return [legacy_copy(i, memo) for i in obj]
+  elif isinstance(obj, tuple):
+    return tuple(legacy_copy(i, memo) for i in obj)
+  elif not hasattr(type(obj), '__slots__'):
+    return obj
+  elif id(obj) in memo:
+    return memo[id(obj)]
+
+  copy = legacy_node()
+  if not isinstance(obj, objs.Type):
+    memo[id(obj)] = copy
+  for cls in type(obj).__mro__:
+    for slot in cls.__dict__.get('__slots__', ()):
+      if hasattr(obj, slot):
+        setattr(copy, slot, legacy_copy(getattr(obj, slot), memo))
+  return copy
+
+
+def read(filename):
+  with open(filename) as source:
+    return source.read()
+
+
+def generate_source(size):
+  # Builds a program of roughly `size` bytes by repeating the functions of the
+  # example program under fresh names. The first copy keeps the original names,
+  # so the result is a valid program with a single main.
+  example = read(EXAMPLE)
+  chunks = [example]
+  total = len(example)
+  copy = 1
+
+  while total < size:
+    chunk = RE_FUNCNAME.sub(r'c%d_\1' % copy, example)
+    chunks.append(chunk)
+    total += len(chunk)
+    copy += 1
+
+  return '\n'.join(chunks)
+
+
+def drain(tokenlist):
+  lines = []
+  while tokenlist:
+    lines.append(tokenlist.read())
+  return lines
+
+
+def bench_lexer(size):
+  text = generate_source(size)
+  megabytes = len(text) / float(1 << 20)
+
+  print 'Lexing %.2f MB of source.' % megabytes
+
+  results = {}
+  for name, cls in (('tokenize', legacy_tokenizer), ('regex', misc.tokenizer)):
+    start = time.time()
+    results[name] = drain(cls(text))
+    elapsed = time.time() - start
+    print '  %-10s %8.3f s %8.2f MB/s' % (name, elapsed, megabytes / elapsed)
+
+  if results['tokenize'] != results['regex']:
+    print 'Token streams differ!'
+    return 1
+
+  return 0
+
+
+def bench_stream(size):
+  text = generate_source(size)
+  (fd, source) = tempfile.mkstemp('.txt')
+  os.write(fd, text)
+  os.close(fd)
+
+  print 'Compiling %.2f MB of source.' % (len(text) / float(1 << 20))
+
+  try:
+    for name, flags in (('whole', []), ('stream', ['--stream'])):
+      start = time.time()
+      child = subprocess.Popen(
+          [sys.executable, 'compiler.py', '-O'] + flags + [source, os.devnull])
+      (pid, status, usage) = os.wait4(child.pid, 0)
+      elapsed = time.time() - start
+
+      if status:
+        print 'Compilation failed.'
+        return 1
+
+      print '  %-10s %8.3f s %8.1f MB peak RSS' % (
+          name, elapsed, usage.ru_maxrss / 1024.0)
+  finally:
+    os.remove(source)
+
+  return 0
+
+
+def bench_threads(count):
+  # Compiles a mix of programs concurrently through one shared Compiler and
+  # checks that every result is byte-identical to a serial compilation.
+  sources = [read(EXAMPLE), generate_source(64 << 10)]
+  jobs = [(sources[i % 2], bool(i & 2)) for i in xrange(count)]
+  session = compiler.Compiler()
+
+  start = time.time()
+  expected = [session.compile_source(text, optimize) for text, optimize in jobs]
+  serial = time.time() - start
+
+  pool = ThreadPool(8)
+  start = time.time()
+  results = pool.map(lambda job: session.compile_source(*job), jobs)
+  threaded = time.time() - start
+  pool.close()
+
+  print 'Compiled %d programs: serial %.3f s, 8 threads %.3f s.' % (
+      count, serial, threaded)
+
+  if results != expected:
+    print 'Concurrent output differs from serial output!'
+    return 1
+
+  return 0
+
+
+def bench_jobs(size):
+  text = generate_source(size)
+  jobs = [1, 2, 4, multiprocessing.cpu_count()]
+
+  print 'Compiling %.2f MB of source on %d CPUs.' % (
+      len(text) / float(1 << 20), jobs[-1])
+
+  # The CPU time of this process, which parses and links the program, bounds
+  # the speedup any number of CPUs can give.
+  functions = len(mparser.parse_program(text))
+  outputs = []
+  for n in sorted(set(jobs)):
+    before = os.times()
+    start = time.time()
+    outputs.append(compiler.Compiler(True, n).compile_source(text))
+    elapsed = time.time() - start
+    after = os.times()
+    workers = compiler.worker_count(n, functions)
+    print '  -j %-4d %8.3f s %8.3f s in the parent %4d workers' % (
+        n, elapsed, after[0] + after[1] - before[0] - before[1],
+        workers if workers > 1 else 0)
+
+  if len(set(outputs)) != 1:
+    print 'Output depends on the number of jobs!'
+    return 1
+
+  return 0
+
+
+def deep_sizeof(root):
+  # Total size of all objects reachable from root, counting shared objects
+  # (e.g. interned types and strings) once.
+  seen = set()
+  stack = [root]
+  total = 0
+
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen or obj is None or isinstance(obj, (bool, type)):
+      continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+      stack.extend(obj.keys())
+      stack.extend(obj.values())
+    elif isinstance(obj, (list, tuple)):
+      stack.extend(obj)
+    elif not isinstance(obj, (basestring, int, long, float)):
+      if hasattr(obj, '__dict__'):
+        stack.append(obj.__dict__)
+      for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+          stack.append(getattr(obj, slot, None))
+
+  return total
+
+
+def bench_memory(size):
+  text = generate_source(size)
+  lines = text.count('\n') + 1
+
+  fset = mparser.parse_program(text)
+  analyser.Analyser().analyse_program(fset)
+  ast = (deep_sizeof(legacy_copy(fset, {})), deep_sizeof(fset))
+
+  collapser.Collapser().collapse_program(fset)
+  gen = generator.Generator(True)
+  fragments = [gen.generate_fragment(k, fset[k]) for k in fset]
+  asm = (deep_sizeof(legacy_copy(fragments, {})), deep_sizeof(fragments))
+
+  print 'Memory for %d source lines, dict-backed and slotted:' % lines
+  for name, (before, after) in (('AST', ast), ('AsmLines', asm)):
+    print '  %-10s %10d %10d bytes %8.1f %8.1f bytes/line (%.2fx)' % (
+        name, before, after, before / float(lines), after / float(lines),
+        float(before) / after)
+
+  return 0
+
+
+def count_words(text, pool):
+  fset = mparser.parse_program(text)
+  analyser.Analyser().analyse_program(fset)
+  collapser.Collapser(pool=pool).collapse_program(fset)
+  return compiler.count_words(generator.Generator(True).generate_program(fset))
+
+
+def bench_pool(size):
+  programs = [('example', read(EXAMPLE)),
+              ('generated', generate_source(size))]
+
+  print 'Words of -O code without and with the constant pool:'
+  for name, text in programs:
+    before = count_words(text, False)
+    after = count_words(text, True)
+    print '  %-10s %8d %8d %8d saved (%.1f%%)' % (
+        name, before, after, before - after, 100.0 * (before - after) / before)
+
+  return 0
+
+
+def bench_peephole(size):
+  text = generate_source(size)
+
+  fset = mparser.parse_program(text)
+  analyser.Analyser().analyse_program(fset)
+  collapser.Collapser(pool=True).collapse_program(fset)
+  gen = generator.Generator(True)
+  optimized = compiler.count_instructions(gen.generate_program(fset))
+  plain = compiler.count_instructions(compiler.Compiler().compile_source(text))
+
+  print 'Peephole rule hits for %d bytes of source:' % len(text)
+  for name in sorted(gen.hits):
+    print '  %-12s %8d' % (name, gen.hits[name])
+  print 'Instructions: %d plain, %d optimized.' % (plain, optimized)
+
+  return 0
+
+
+def bench_levels(limit):
+  # Words of code and data and instructions executed by the example programs
+  # compiled at each optimization level, running at most `limit` instructions.
+  library = (runtime.LIBRARY, read(runtime.LIBRARY))
+  print 'Words and simulator steps at each optimization level:'
+
+  for filename in (EXAMPLE, ARITH):
+    text = read(filename)
+    expected = None
+    for level, flag in interpreter.LEVELS:
+      program = compiler.Compiler(level).compile_source(text)
+      machine = simulator.run([library, ('program', program)], limit)[0]
+      if not machine.halted:
+        print 'Program did not halt!'
+        return 1
+      if expected is None:
+        expected = machine.output
+      elif machine.output != expected:
+        print 'Output differs at %s!' % flag
+        return 1
+      print '  %-12s %-6s %6d words %10d steps' % (
+          os.path.basename(filename), flag or 'no -O',
+          compiler.count_words(program), machine.steps)
+
+  return 0
+
+
+def bench_simulator(runs):
+  # Instructions per second of the simulator on the example programs, and on
+  # arith.txt looping 1000 times, best of `runs` runs of each.
+  library = (runtime.LIBRARY, read(runtime.LIBRARY))
+  arith = read(ARITH)
+  programs = [(EXAMPLE, read(EXAMPLE)),
+              (ARITH, arith),
+              ('arith.txt x1000', arith.replace('i < 7', 'i < 1000'))]
+  print 'Simulator throughput, best of %d runs:' % runs
+
+  for name, text in programs:
+    for optimize in (False, True):
+      program = compiler.Compiler(optimize).compile_source(text)
+      memory = simulator.assemble([library, (name, program)])[0]
+
+      best = None
+      for i in xrange(runs):
+        machine = simulator.Machine(memory)
+        start = time.time()
+        machine.run()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+      if not machine.halted:
+        print 'Program did not halt!'
+        return 1
+
+      print '  %-22s %-3s %9d steps %8.3f s %10.0f instructions/s' % (
+          name, '-O' if optimize else '', machine.steps, best,
+          machine.steps / max(best, 1e-6))
+
+  return 0
+
+
+def bench_interpreter(runs):
+  # Time to run the example programs in the interpreter, against the time to
+  # run them compiled without -O in the simulator, best of `runs` runs of each.
+  library = (runtime.LIBRARY, read(runtime.LIBRARY))
+  print 'Interpreter against simulator, best of %d runs:' % runs
+
+  for filename in (EXAMPLE, ARITH):
+    text = read(filename)
+    program = compiler.Compiler().compile_source(text)
+    memory = simulator.assemble([library, (filename, program)])[0]
+
+    best = {}
+    for i in xrange(runs):
+      for engine in ('interpreter', 'simulator'):
+        if engine == 'interpreter':
+          machine = interpreter.load(text)
+        else:
+          machine = simulator.Machine(memory)
+        start = time.time()
+        machine.run()
+        elapsed = time.time() - start
+        best[engine] = min(best.get(engine, elapsed), elapsed)
+
+        if not machine.halted:
+          print 'Program did not halt!'
+          return 1
+
+    print '  %-22s %8.4f s against %8.4f s, %5.1fx' % (
+        filename, best['interpreter'], best['simulator'],
+        best['simulator'] / max(best['interpreter'], 1e-6))
+
+  return 0
+
+
+BENCHMARKS = {
+  'interpreter': (bench_interpreter, 5),
+  'jobs': (bench_jobs, 1 << 20),
+  'levels': (bench_levels, 10 ** 7),
+  'lexer': (bench_lexer, 4 << 20),
+  'memory': (bench_memory, 1 << 20),
+  'peephole': (bench_peephole, 0),
+  'pool': (bench_pool, 16 << 10),
+  'simulator': (bench_simulator, 5),
+  'stream': (bench_stream, 4 << 20),
+  'threads': (bench_threads, 64),
+}
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+
+  if len(args) in (1, 2) and args[0] in BENCHMARKS:
+    func, n = BENCHMARKS[args[0]]
+    if len(args) == 2:
+      n = int(args[1])
+    sys.exit(func(n))
+  else:
+    print 'Usage: benchmark (%s) [n]' % '|'.join(sorted(BENCHMARKS))
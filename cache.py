@@ -0,0 +1,60 @@
+import cPickle
+import errno
+import hashlib
+import os
+import tempfile
+
+
+# Bump whenever the generated code for unchanged source, or the pickled form
+# of fragments, may change.
+CACHE_VERSION = 13
+
+
+def artifact_key(*parts):
+  digest = hashlib.sha1('mano-cache-%d' % CACHE_VERSION)
+  for part in parts:
+    digest.update(repr(part))
+    digest.update('\0')
+  return digest.hexdigest()
+
+
+class ArtifactCache(object):
+  # On-disk store of compiled functions (see compiler.compile_function), keyed
+  # by artifact_key.
+  # Entries are written to a temporary file and renamed into place, so several
+  # compilers may share a cache directory.
+  def __init__(self, directory):
+    self.directory = directory
+    self.hits = 0
+    self.misses = 0
+
+  def path(self, key):
+    return os.path.join(self.directory, key[:2], key[2:])
+
+  def get(self, key):
+    # A missing entry is a miss, and so is one that cannot be loaded, which
+    # unpickling a truncated or corrupted file may report as about anything.
+    # The compiler then overwrites it.
+    try:
+      with open(self.path(key), 'rb') as f:
+        fragment = cPickle.load(f)
+    except Exception:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    return fragment
+
+  def put(self, key, fragment):
+    path = self.path(key)
+
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+      cPickle.dump(fragment, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmppath, path)
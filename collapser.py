@@ -1,82 +1,237 @@
-from misc import ManoCollapserError
+import hashlib
+from misc import ManoCollapserError, constantLabel, paramLabel
 from objs import *
 
 
-NAMES_COUNT = 0
-
-
-def genId():
-  global NAMES_COUNT
-  NAMES_COUNT += 1
-  return 'q%05d' % NAMES_COUNT
-
-
 def collapse_program(functionset):
-  global NAMES_COUNT
-
-  if not (isinstance(functionset, dict)):
-    raise ManoCollapserError('Input program is not a dictionary of functions.')
+  return Collapser().collapse_program(functionset)
+
+
+def collapse_stream(functions, signatures):
+  return Collapser().collapse_stream(functions, signatures)
+
+
+class Collapser(object):
+  # In namespaced mode function names are derived from the original names
+  # rather than from declaration order, and locals are numbered within their
+  # function (see collapse_function), so the collapsed code of a function
+  # does not change when other functions are added, removed or edited.
+  #
+  # If symbols is a list, a (function, kind, name, collapsed name) tuple is
+  # appended to it for every function, parameter, variable, constant and label
+  # renamed.
+  #
+  # With pool set, constants that are never written are renamed after their
+  # value (see misc.constantLabel), so that the generator can emit a single
+  # copy of each for the whole program.
+  #
+  # With direct set, parameters are renamed after their function and position
+  # (see misc.paramLabel), so that callers can store arguments in them without
+  # knowing the function's other names.
+  def __init__(self, namespaced=False, symbols=None, pool=False, direct=False):
+    self.namespaced = namespaced
+    self.symbols = symbols
+    self.pool = pool
+    self.direct = direct
+    self.names_count = 0
+    self.namespace = None
+    self.local_count = 0
+
+    # Names are looked up in the names local to the function being collapsed
+    # first, then in the table of function names.
+    self.globals = {}
+    self.locals = {}
+    self.funcname = None
+
+    self.visitors = {
+      GotoLine: self.visit_line,
+      PrintLine: self.visit_line,
+      ReadLine: self.visit_line,
+      ReturnLine: self.visit_line,
+      AssignLine: self.visit_assign,
+      Identifier: self.visit_identifier,
+      Call: self.visit_call,
+      UnaryOperation: self.visit_unary,
+      BinaryOperation: self.visit_binary,
+    }
+
+  def genId(self):
+    if self.namespace:
+      self.local_count += 1
+      return '%s_%d' % (self.namespace, self.local_count)
+
+    self.names_count += 1
+    return 'q%05d' % self.names_count
+
+  def collapse_program(self, functionset):
+    if not (isinstance(functionset, dict)):
+      raise ManoCollapserError('Input program is not a dictionary of functions.')
+
+    self.names_count = 0
+
+    global_lookup = self.collapse_names(functionset)
+
+    for funcname, func in functionset.items():
+      self.collapse_function(func, global_lookup, funcname=funcname)
+
+    # Rename functions.
+    funcs = functionset.keys()
+    for funcname in funcs:
+      if funcname != 'main':
+        functionset[global_lookup[funcname]] = functionset[funcname]
+        del functionset[funcname]
+
+    return functionset
+
+  def collapse_stream(self, functions, signatures):
+    self.names_count = 0
+
+    global_lookup = self.collapse_names(signatures)
+
+    for funcname, func in functions:
+      self.collapse_function(func, global_lookup, funcname=funcname)
+      yield global_lookup[funcname], func
+
+  def collapse_names(self, funcnames):
+    # Construct lookup table.
+    global_lookup = {'main': 'main', 'null': 'null'}
+
+    if self.namespaced:
+      used = set(global_lookup.values())
+      for funcname in sorted(funcnames):
+        if funcname != 'main':
+          digest = hashlib.md5(funcname).hexdigest()
+          size = 5
+          while 'q' + digest[:size] in used:
+            size += 1
+          global_lookup[funcname] = 'q' + digest[:size]
+          used.add(global_lookup[funcname])
+    else:
+      for funcname in funcnames:
+        if funcname != 'main':
+          global_lookup[funcname] = self.genId()
+
+    return global_lookup
+
+  def collapse_function(self, func, global_lookup, namespace=None,
+                        funcname=None):
+    # With a namespace (the function's own collapsed name), local names are
+    # numbered per function instead of program-wide. funcname is used to
+    # record symbols, and to name parameters in direct mode.
+    self.namespace = namespace
+    self.local_count = 0
+    self.funcname = funcname
+    self.globals = global_lookup
+    self.locals = {}
+
+    if funcname is not None:
+      self.record('function', funcname, global_lookup[funcname])
 
-  NAMES_COUNT = 0
-
-  # Construct lookup table.
-  global_lookup = {'main': 'main', 'null': 'null'}
-  for funcname in functionset:
-    if funcname != 'main':
-      global_lookup[funcname] = genId()
+    varnames = func.vars.keys()
+    if namespace:
+      # Dictionary order may change when a function is sent to a worker.
+      varnames.sort()
 
-  for func in functionset.values():
-    lookup = {}
-    lookup.update(global_lookup)
+    written = self.written_names(func) if self.pool else None
 
-    varnames = func.vars.keys()
+    variables = {}
     for varname in varnames:
-      lookup[varname] = genId()
-      func.vars[lookup[varname]] = func.vars[varname]
-      del func.vars[varname]
+      (typ, value) = func.vars[varname]
+      if varname in func.params:
+        if self.direct:
+          self.locals[varname] = paramLabel(global_lookup[funcname],
+                                            func.params.index(varname))
+        else:
+          self.locals[varname] = self.genId()
+        self.record('param', varname, self.locals[varname])
+      elif value is not None:
+        if self.pool and varname not in written:
+          self.locals[varname] = constantLabel(typ, value)
+        else:
+          self.locals[varname] = self.genId()
+        self.record('const', varname, self.locals[varname])
+      else:
+        self.locals[varname] = self.genId()
+        self.record('var', varname, self.locals[varname])
+
+      variables[self.locals[varname]] = func.vars[varname]
+
+    func.vars = variables
 
     for i in range(len(func.params)):
-      func.params[i] = lookup[func.params[i]]
+      func.params[i] = self.locals[func.params[i]]
 
     for line in func.code:
-      attrs = ['label', 'condition', 'target', 'index']
-
-      for attr in attrs:
-        if hasattr(line, attr) and getattr(line, attr):
-          name = getattr(line, attr)
+      self.visit(line)
 
-          if name not in lookup:
-            lookup[name] = genId()
+    self.namespace = None
+    self.funcname = None
+    self.locals = {}
 
-          setattr(line, attr, lookup[name])
+    return func
 
-      if hasattr(line, 'expression'):
-        exp = line.expression
-        attrs = ['function', 'name', 'index', 'operand', 'left', 'right']
-
-        for attr in attrs:
-          if hasattr(exp, attr) and getattr(exp, attr):
-            name = getattr(exp, attr)
-
-            if name not in lookup:
-              lookup[name] = genId()
-
-            setattr(exp, attr, lookup[name])
-
-        if hasattr(exp, 'arguments'):
-          for i in range(len(exp.arguments)):
-            name = exp.arguments[i]
-
-            if name not in lookup:
-              lookup[name] = genId()
-
-            exp.arguments[i] = lookup[name]
-
-  # Rename functions.
-  funcs = functionset.keys()
-  for funcname in funcs:
-    if funcname != 'main':
-      functionset[lookup[funcname]] = functionset[funcname]
-      del functionset[funcname]
-
-  return functionset
+  def written_names(self, func):
+    # Names that are assigned to, or whose storage is passed to another
+    # function, which may write to it.
+    names = set()
+    for line in func.code:
+      if isinstance(line, (AssignLine, ReadLine)):
+        names.add(line.target)
+      if isinstance(line, AssignLine) and isinstance(line.expression, Call):
+        for name in line.expression.arguments:
+          if name in func.vars and func.vars[name][0].name != 'WORD':
+            names.add(name)
+
+    return names
+
+  def record(self, kind, name, collapsed):
+    if self.symbols is not None:
+      self.symbols.append((self.funcname, kind, name, collapsed))
+
+  def rename(self, name):
+    if not name:
+      return name
+
+    collapsed = self.locals.get(name)
+    if collapsed is None:
+      collapsed = self.globals.get(name)
+      if collapsed is None:
+        collapsed = self.locals[name] = self.genId()
+
+    return collapsed
+
+  def visit(self, node):
+    try:
+      visitor = self.visitors[type(node)]
+    except KeyError:
+      raise ManoCollapserError('Unrecognized node type %s.' %
+                               type(node).__name__)
+    visitor(node)
+
+  def visit_line(self, line):
+    if line.label:
+      label = line.label
+      line.label = self.rename(label)
+      self.record('label', label, line.label)
+    line.condition = self.rename(line.condition)
+    line.target = self.rename(line.target)
+
+  def visit_assign(self, line):
+    self.visit_line(line)
+    line.index = self.rename(line.index)
+    self.visit(line.expression)
+
+  def visit_identifier(self, exp):
+    exp.name = self.rename(exp.name)
+    exp.index = self.rename(exp.index)
+
+  def visit_call(self, exp):
+    exp.function = self.rename(exp.function)
+    exp.arguments = [self.rename(i) for i in exp.arguments]
+
+  def visit_unary(self, exp):
+    exp.operand = self.rename(exp.operand)
+
+  def visit_binary(self, exp):
+    exp.left = self.rename(exp.left)
+    exp.right = self.rename(exp.right)
@@ -1,31 +1,629 @@
 #!/usr/bin/python2
 
+import argparse
+import json
+import multiprocessing
+import os
 import sys
+import time
 import mparser
 import analyser
 import collapser
 import generator
+import profiler
+import runtime
+import simulator
+from cache import ArtifactCache, artifact_key
+from misc import ManoGeneratorError, ManoParserError
 
+try:
+  import resource
+except ImportError:
+  # Not on Windows.
+  resource = None
 
-def compile(infile, outfile, optimize=False):
-  generator.OPTIMIZED_MODE = optimize
-  fset = mparser.parse_program(open(infile).read())
-  analyser.analyse_program(fset)
-  collapser.collapse_program(fset)
-  out = generator.generate_program(fset)
-  open(outfile, 'w').write(out)
+
+class Compiler(object):
+  # All per-compilation state lives in the phase objects created for each
+  # call, so a single Compiler may be shared between threads.
+  def __init__(self, optimize=False, jobs=None, cache=None):
+    self.optimize = optimize
+    self.jobs = jobs
+    self.cache = cache
+
+  def compile_source(self, text, optimize=None, symbols=None, lines=None,
+                     stats=None):
+    # If symbols is a list, a (function, kind, name, collapsed name, assembly
+    # label) tuple is appended to it for every name in the program. If lines
+    # is a list, the line table of the output is appended to it (see
+    # generator.Generator), with the names functions have in the source. If
+    # stats is a dict, the statistics of the compilation are stored in it
+    # (see Stats), unless it is parallel or cached.
+    if optimize is None:
+      optimize = self.optimize
+
+    if self.cache is not None:
+      return self.compile_cached(text, optimize, symbols, lines)
+
+    if self.jobs:
+      return self.compile_parallel(text, optimize, symbols, lines)
+
+    phases = Stats(stats)
+    fset = mparser.parse_program(text)
+    phases.end('parse')
+    phases.count_program(fset)
+
+    records = []
+    analyser.Analyser().analyse_program(fset)
+    live = analyser.reachable(analyser.call_graph(fset))
+    for funcname in fset.keys():
+      if funcname not in live:
+        del fset[funcname]
+    phases.end('analyse')
+
+    collapser.Collapser(symbols=records, pool=optimize,
+                        direct=optimize).collapse_program(fset)
+    direct = analyser.direct_functions(analyser.call_graph(fset)) \
+             if optimize else ()
+    phases.end('collapse')
+
+    table = [] if lines is not None else None
+    gen = generator.Generator(optimize, direct=direct, table=table)
+    out = gen.generate_program(fset)
+    phases.end('generate')
+    phases.count_output(out, gen, records)
+
+    if symbols is not None:
+      symbols.extend(resolve_symbols(records, gen.labels))
+    if lines is not None:
+      lines.extend(resolve_lines(table, records))
+    return out
+
+  def compile_parallel(self, text, optimize, symbols=None, lines=None):
+    # Parses, analyses and generates each function independently, in a pool of
+    # self.jobs worker processes, and links the resulting buffers in order.
+    # Only the headers are parsed here; the workers get the source of each
+    # function. Labels are namespaced per function, so the output does not
+    # depend on the number of workers.
+    calls = {}
+    blocks = list(mparser.split_program(text, calls))
+    context = self.make_context(block_signatures(blocks), optimize, calls)
+    results = self.compile_functions([i[2:] for i in blocks], context)
+
+    return self.link(zip([i[0] for i in blocks], results), optimize, calls,
+                     symbols, lines)
+
+  def compile_cached(self, text, optimize, symbols=None, lines=None):
+    # Only functions whose source, or the signature table of the program,
+    # changed since they were last compiled are parsed and generated again.
+    # The fragments of the others are loaded from self.cache.
+    calls = {}
+    blocks = list(mparser.split_program(text, calls))
+    signatures = block_signatures(blocks)
+    context = self.make_context(signatures, optimize, calls)
+    (names, direct) = (context[2], context[4])
+    table = sorted(signatures.items())
+
+    keys = []
+    results = []
+    for funcname, signature, source, start in blocks:
+      # Which of the function and its callees are called directly.
+      linked = sorted(i for i in calls[funcname] | set([funcname])
+                      if names.get(i) in direct)
+      keys.append(artifact_key(optimize, table, funcname, source, linked))
+      results.append(self.cache.get(keys[-1]))
+
+    missing = [i for i in xrange(len(blocks)) if results[i] is None]
+    sources = [blocks[i][2:] for i in missing]
+
+    # Entries keep the source lines of the fragment relative to the start of
+    # the function, so they stay valid when lines are added above it.
+    for i, result in zip(missing, self.compile_functions(sources, context)):
+      rebase_lines(result[0], -blocks[i][3])
+      self.cache.put(keys[i], result)
+      results[i] = result
+    for block, result in zip(blocks, results):
+      rebase_lines(result[0], block[3])
+
+    return self.link(zip([i[0] for i in blocks], results), optimize, calls,
+                     symbols, lines)
+
+  def link(self, results, optimize, calls, symbols=None, lines=None):
+    # Links the (fragment, symbols, pool) tuples returned by compile_function,
+    # paired with the name of their function. Functions that main never calls
+    # are left out.
+    live = analyser.reachable(calls)
+    results = [i for i in results if i[0] in live]
+
+    pool = {}
+    fragments = []
+    names = []
+    for funcname, (fragment, records, constants) in results:
+      fragments.append(fragment)
+      pool.update(constants)
+      names.extend(records)
+
+    if symbols is not None:
+      symbols.extend(names)
+    table = [] if lines is not None else None
+    out = generator.Generator(optimize, table=table).link(fragments, pool)
+    if lines is not None:
+      lines.extend(resolve_lines(table, names))
+    return out
+
+  def make_context(self, signatures, optimize, calls):
+    # Everything compile_function needs to know about the rest of the program.
+    names = collapser.Collapser(namespaced=True).collapse_names(signatures)
+    direct = set()
+    if optimize:
+      direct = set(names[i] for i in analyser.direct_functions(calls))
+
+    return (signatures,
+            analyser.Analyser().build_global_lookup(signatures),
+            names,
+            optimize,
+            direct)
+
+  def compile_functions(self, sources, context):
+    # Compiles the (source, starting line) of each function, as split_program
+    # yields them.
+    jobs = worker_count(self.jobs, len(sources))
+    if jobs < 2:
+      return [compile_source_function(i, context) for i in sources]
+
+    pool = multiprocessing.Pool(jobs, init_worker, (context,))
+    try:
+      chunksize = len(sources) // (jobs * 4) + 1
+      return pool.map(compile_worker, sources, chunksize)
+    finally:
+      pool.terminate()
+
+  def check_source(self, text):
+    # Returns every type error in the program instead of stopping at the first.
+    # Nothing can be checked past a syntax error, which is returned alone.
+    try:
+      fset = mparser.parse_program(text)
+    except ManoParserError, e:
+      return [e]
+    return analyser.check_program(fset)
+
+  def compile_file(self, infile, outfile, optimize=None, symbols=None,
+                   lines=None, stats=None):
+    with open(infile) as source:
+      text = source.read()
+    out = self.compile_source(text, optimize, symbols, lines, stats)
+    with open(outfile, 'w') as program:
+      program.write(out)
+
+  def compile_stream(self, infile, outfile, optimize=None, symbols=None,
+                     lines=None):
+    # Compiles one function at a time. Only the signature table of the program,
+    # collected in a first pass over the source, is kept across functions.
+    if optimize is None:
+      optimize = self.optimize
+
+    calls = {}
+    with open(infile) as source:
+      signatures = mparser.parse_signatures(source, calls)
+    if 'main' not in signatures:
+      raise ManoGeneratorError, 'Program contains no "main" function.'
+
+    direct = ()
+    if optimize:
+      # The names collapse_stream gives to the functions.
+      names = collapser.Collapser().collapse_names(signatures)
+      direct = set(names[i] for i in analyser.direct_functions(calls))
+
+    records = [] if symbols is not None or lines is not None else None
+    table = [] if lines is not None else None
+    gen = generator.Generator(optimize, direct=direct, table=table)
+
+    with open(infile) as source, open(outfile, 'w') as out:
+      functions = mparser.iter_program(source)
+      functions = analyser.Analyser().analyse_stream(functions, signatures)
+      live = analyser.reachable(calls)
+      functions = ((k, func) for k, func in functions if k in live)
+      collapse = collapser.Collapser(symbols=records, pool=optimize,
+                                     direct=optimize)
+      functions = collapse.collapse_stream(functions, signatures)
+      gen.generate_stream(functions, out)
+
+    if symbols is not None:
+      symbols.extend(resolve_symbols(records, gen.labels))
+    if lines is not None:
+      lines.extend(resolve_lines(table, records))
+
+
+class Stats(object):
+  # Records statistics of a compilation into a dict, if there is one: the
+  # time each phase took and the peak memory of the process by its end (in
+  # KiB, or None where unknown), in phases, in order; the functions,
+  # statements and constants (literals included) of the program as parsed;
+  # and, for the output, its words and instructions, the lines each function
+  # was generated as and left with by the peephole optimizer, the constants
+  # pooled, and the times each rewrite of the generator and each peephole rule
+  # applied.
+  def __init__(self, stats):
+    self.stats = stats
+    self.start = time.time()
+    if stats is not None:
+      stats.setdefault('phases', [])
+
+  def end(self, phase):
+    if self.stats is None:
+      return
+    now = time.time()
+    self.stats['phases'].append({'phase': phase, 'time': now - self.start,
+                                 'peak_memory': peak_memory()})
+    self.start = time.time()
+
+  def count_program(self, fset):
+    if self.stats is None:
+      return
+    self.stats['functions'] = len(fset)
+    self.stats['statements'] = sum(len(i.code) for i in fset.itervalues())
+    self.stats['constants'] = sum(1 for func in fset.itervalues()
+                                  for typ, value in func.vars.itervalues()
+                                  if value is not None)
+    self.start = time.time()
+
+  def count_output(self, out, gen, records):
+    if self.stats is None:
+      return
+    names = dict((i[3], i[2]) for i in records if i[1] == 'function')
+    self.stats['words'] = count_words(out)
+    self.stats['instructions'] = count_instructions(out)
+    self.stats['lines'] = dict(
+        (names.get(name, name), {'emitted': emitted, 'kept': kept})
+        for name, (emitted, kept) in gen.sizes.iteritems())
+    self.stats['pooled'] = len(gen.pool)
+    self.stats['rewrites'] = dict(gen.rewrites)
+    self.stats['peephole'] = dict(gen.hits)
+    self.start = time.time()
+
+
+def peak_memory():
+  # Largest resident set of the process so far, in KiB.
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def compile_function(function, context):
+  # Returns the generated fragment, the symbols and the pooled constants of a
+  # function.
+  (funcname, func) = function
+  (signatures, global_lookup, names, optimize, direct) = context
+
+  records = []
+  analyser.Analyser().analyse_function(
+      funcname, func, signatures, global_lookup)
+  collapser.Collapser(symbols=records, pool=optimize,
+                      direct=optimize).collapse_function(
+      func, names, names[funcname], funcname)
+
+  gen = generator.Generator(optimize, namespaced=True, direct=direct)
+  fragment = gen.generate_fragment(names[funcname], func)
+  return fragment, resolve_symbols(records, gen.labels), gen.pool
+
+
+def compile_source_function(source, context):
+  # compile_function on the function in the source text starting at the given
+  # line.
+  (text, start) = source
+  return compile_function(next(mparser.iter_program(text, start)), context)
+
+
+def block_signatures(blocks):
+  # The signature of each function split_program yielded.
+  signatures = {}
+  for funcname, signature, source, start in blocks:
+    if funcname in signatures:
+      raise ManoParserError('Duplicate function declaration.', start)
+    signatures[funcname] = signature
+
+  if 'main' not in signatures:
+    raise ManoGeneratorError, 'Program contains no "main" function.'
+  return signatures
+
+
+def resolve_symbols(records, labels):
+  # Adds the assembly label to the records made by the collapser. Functions
+  # and arrays are labeled with their collapsed name by a pointer to their
+  # code or data; everything else is labeled with its collapsed name.
+  return [record + (labels.get(record[3], record[3]),) for record in records]
+
+
+def rebase_lines(fragment, offset):
+  # Adds offset to the source lines of the lines of a fragment.
+  for line in fragment:
+    if line is not None and line.source and line.source[2] is not None:
+      (function, statement, lineno) = line.source
+      line.source = (function, statement, lineno + offset)
+
+
+def resolve_lines(table, records):
+  # Replaces the collapsed names of functions in a line table with their names
+  # in the source.
+  names = dict((i[3], i[2]) for i in records if i[1] == 'function')
+  return [(line, names.get(function, function), statement, source)
+          for line, function, statement, source in table]
+
+
+def write_symbols(symbols, outfile):
+  with open(outfile, 'w') as out:
+    out.write('# function kind name collapsed label\n')
+    for record in sorted(symbols):
+      out.write('%s %s %s %s %s\n' % record)
+
+
+# Context shared by all jobs of a worker process, set once by init_worker.
+WORKER_CONTEXT = None
+# Fewest functions worth handing to each worker process. Starting a worker and
+# pickling sources to it and fragments back takes about as long as compiling
+# a hundred functions of the example program.
+JOB_FUNCTIONS = 128
+
+
+def worker_count(jobs, functions):
+  # Worker processes to compile a number of functions in, with -j jobs: no
+  # more than there are CPUs, nor than give each JOB_FUNCTIONS of them. Fewer
+  # than two means compiling them in this process.
+  try:
+    cpus = multiprocessing.cpu_count()
+  except NotImplementedError:
+    cpus = 1
+  return min(jobs or 1, cpus, functions // JOB_FUNCTIONS)
+
+
+def init_worker(context):
+  global WORKER_CONTEXT
+  WORKER_CONTEXT = context
+
+
+def compile_worker(source):
+  return compile_source_function(source, WORKER_CONTEXT)
+
+
+def compile_batch(srcdir, outdir, optimize=False, jobs=None, cachedir=None):
+  # Compiles every file under srcdir into the same relative path under outdir,
+  # one file per job in a pool of worker processes. Returns a list of
+  # (path, source lines, instructions emitted, error, cache hits, cache misses)
+  # tuples, one per file, and the elapsed time. A failing file is reported in
+  # its tuple and does not stop the batch.
+  tasks = []
+  for dirpath, dirnames, filenames in os.walk(srcdir):
+    dirnames[:] = sorted(i for i in dirnames if not i.startswith('.'))
+    for filename in sorted(filenames):
+      if not filename.startswith('.'):
+        path = os.path.relpath(os.path.join(dirpath, filename), srcdir)
+        tasks.append((srcdir, outdir, path, optimize, cachedir))
+
+  start = time.time()
+  if jobs == 1 or len(tasks) < 2:
+    results = map(compile_batch_file, tasks)
+  else:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(compile_batch_file, tasks, 1)
+    finally:
+      pool.terminate()
+
+  return results, time.time() - start
+
+
+def compile_batch_file(task):
+  (srcdir, outdir, path, optimize, cachedir) = task
+  outfile = os.path.join(outdir, path)
+  (lines, instructions, error) = (0, 0, None)
+  cache = ArtifactCache(cachedir) if cachedir else None
+
+  try:
+    with open(os.path.join(srcdir, path)) as source:
+      text = source.read()
+    lines = text.count('\n') + 1
+
+    out = Compiler(optimize, None, cache).compile_source(text)
+
+    if not os.path.isdir(os.path.dirname(outfile) or '.'):
+      os.makedirs(os.path.dirname(outfile))
+    with open(outfile, 'w') as program:
+      program.write(out)
+    instructions = count_instructions(out)
+  except Exception, e:
+    error = '%s: %s' % (type(e).__name__, e)
+
+  (hits, misses) = (cache.hits, cache.misses) if cache else (0, 0)
+  return (path, lines, instructions, error, hits, misses)
+
+
+def count_instructions(text):
+  count = 0
+  for line in text.split('\n'):
+    parts = line.split(',', 1)[-1].split()
+    if parts and parts[0] not in ('ORG', 'DEC', 'HEX', 'END'):
+      count += 1
+  return count
+
+
+def check(infile):
+  with open(infile) as source:
+    text = source.read()
+  return Compiler().check_source(text)
+
+
+def count_words(text):
+  # Memory words taken by the program: instructions and data.
+  count = 0
+  for line in text.split('\n'):
+    parts = line.split(';', 1)[0].split(',', 1)[-1].split()
+    if parts and parts[0] not in ('ORG', 'END'):
+      count += 1
+  return count
+
+
+def link(outfile):
+  # Appends the part of the runtime library the compiled program uses to it,
+  # and returns the number of words of the library left out.
+  with open(outfile) as program:
+    (text, saved) = runtime.link(program)
+  with open(outfile, 'a') as out:
+    out.write(text)
+  return saved
+
+
+def program_sources(outfile, linked=False):
+  # The compiled program, after the runtime library unless it was linked in.
+  with open(outfile) as program:
+    sources = [(outfile, program.read())]
+  if not linked:
+    with open(runtime.LIBRARY) as library:
+      sources.insert(0, (runtime.LIBRARY, library.read()))
+  return sources
+
+
+def run(outfile, linked=False):
+  # Runs the compiled program in the simulator, and returns the machine and
+  # its speed in instructions per second.
+  return simulator.run(program_sources(outfile, linked))
+
+
+def profile(infile, outfile, lines, linked=False):
+  # Runs the program compiled from infile, with the line table lines, in the
+  # profiler and returns its profile.
+  return profiler.Profile(program_sources(outfile, linked), outfile, lines,
+                          infile)
+
+
+def compile(infile, outfile, optimize=False, jobs=None, cache=None,
+            symfile=None, lines=None, stats=None):
+  symbols = [] if symfile else None
+  Compiler(optimize, jobs, cache).compile_file(infile, outfile, None, symbols,
+                                               lines, stats)
+  if symfile:
+    write_symbols(symbols, symfile)
+
+
+def compile_stream(infile, outfile, optimize=False, symfile=None, lines=None):
+  symbols = [] if symfile else None
+  Compiler(optimize).compile_stream(infile, outfile, None, symbols, lines)
+  if symfile:
+    write_symbols(symbols, symfile)
 
 
 if __name__ == '__main__':
-  args = sys.argv[1:]
-
-  if len(args) == 3 and args[0] == '-O':
-    compile(args[1], args[2], True)
-  elif len(args) == 2 and args[0] == '-O':
-    compile(args[1], 'out.txt', True)
-  elif len(args) == 2:
-    compile(args[0], args[1], False)
-  elif len(args) == 1:
-    compile(args[0], 'out.txt', False)
+  parser = argparse.ArgumentParser(prog='compiler')
+  parser.add_argument('-O', dest='optimize', action='store_const', const=True,
+                      default=False, help='produce optimized code')
+  parser.add_argument('-O2', dest='optimize', action='store_const', const=2,
+                      help='optimize for speed, unrolling larger arrays')
+  parser.add_argument('-Os', dest='optimize', action='store_const', const='s',
+                      help='optimize for size, never unrolling arrays')
+  parser.add_argument('-j', dest='jobs', type=int, metavar='N',
+                      help='analyse and generate functions in N processes')
+  parser.add_argument('--stream', action='store_true',
+                      help='compile one function at a time in bounded memory')
+  parser.add_argument('--cache', metavar='DIR',
+                      help='reuse unchanged functions compiled into DIR')
+  parser.add_argument('--batch', action='store_true',
+                      help='compile every file under the source directory '
+                           'into the object directory')
+  parser.add_argument('--symbols', metavar='FILE',
+                      help='write a map of source names to assembly labels '
+                           'to FILE')
+  parser.add_argument('--check', action='store_true',
+                      help='only report every type error in the program')
+  parser.add_argument('--stats', metavar='FILE',
+                      help='write the time and peak memory of each phase, and '
+                           'counts of what was compiled, to FILE as JSON')
+  parser.add_argument('--link', action='store_true',
+                      help='append the runtime routines the program uses')
+  parser.add_argument('--run', action='store_true',
+                      help='run the compiled program in the simulator')
+  parser.add_argument('--profile', metavar='FILE',
+                      help='run the compiled program in the profiler, report '
+                           'where it spends its cycles and write them to FILE '
+                           'for callgrind tools')
+  parser.add_argument('source_file')
+  parser.add_argument('object_file', nargs='?', default='out.txt')
+  args = parser.parse_args()
+
+  if args.jobs is not None and args.jobs < 1:
+    parser.error('-j needs at least one job')
+  if args.stream and (args.jobs or args.cache or args.batch):
+    parser.error('--stream cannot be combined with -j, --cache or --batch')
+  if args.symbols and args.batch:
+    parser.error('--symbols cannot be combined with --batch')
+  if (args.link or args.run or args.profile) and args.batch:
+    parser.error('--link, --run and --profile cannot be combined with --batch')
+  if args.stats and (args.jobs or args.cache or args.batch or args.stream or
+                     args.check):
+    parser.error('--stats cannot be combined with -j, --cache, --batch, '
+                 '--stream or --check')
+
+  lines = [] if args.profile else None
+  stats = {'source': args.source_file, 'optimize': args.optimize} \
+          if args.stats else None
+
+  if args.check:
+    errors = check(args.source_file)
+    for error in errors:
+      print error
+    sys.exit(1 if errors else 0)
+  elif args.batch:
+    if not os.path.isdir(args.source_file):
+      parser.error('--batch needs a source directory')
+
+    results, elapsed = compile_batch(args.source_file, args.object_file,
+                                     args.optimize, args.jobs, args.cache)
+
+    for path, lines, instructions, error, hits, misses in results:
+      if error:
+        print '%s: %s' % (path, error)
+
+    failed = len([i for i in results if i[3]])
+    lines = sum(i[1] for i in results)
+    instructions = sum(i[2] for i in results)
+    elapsed = max(elapsed, 1e-6)
+
+    print 'Compiled %d files (%d failed) in %.2f s.' % (
+        len(results), failed, elapsed)
+    print '%.1f files/s, %.0f lines/s, %d instructions emitted.' % (
+        len(results) / elapsed, lines / elapsed, instructions)
+    if args.cache:
+      print 'Cache: %d hits, %d misses.' % (sum(i[4] for i in results),
+                                            sum(i[5] for i in results))
+    sys.exit(1 if failed else 0)
+  elif args.stream:
+    compile_stream(args.source_file, args.object_file, args.optimize,
+                   args.symbols, lines)
   else:
-    print 'Usage: compiler [-O] source_file [object_file]'
+    cache = ArtifactCache(args.cache) if args.cache else None
+    compile(args.source_file, args.object_file, args.optimize, args.jobs, cache,
+            args.symbols, lines, stats)
+    if cache:
+      print 'Cache: %d hits, %d misses.' % (cache.hits, cache.misses)
+
+  if args.link:
+    phases = Stats(stats)
+    saved = link(args.object_file)
+    phases.end('link')
+    print 'Runtime: %d of %d words left out.' % (saved, runtime.load().words())
+
+  if args.stats:
+    with open(args.stats, 'w') as out:
+      json.dump(stats, out, indent=2, separators=(',', ': '), sort_keys=True)
+      out.write('\n')
+
+  if args.run:
+    (machine, speed) = run(args.object_file, args.link)
+    sys.stdout.write(machine.transcript())
+    print 'Simulated %.0f instructions/s.' % speed
+
+  if args.profile:
+    result = profile(args.source_file, args.object_file, lines, args.link)
+    if not args.run:
+      sys.stdout.write(result.machine.transcript())
+    sys.stdout.write(result.report())
+    result.write_callgrind(args.profile)
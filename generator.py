@@ -1,445 +1,933 @@
-from misc import ManoGeneratorError
+import peephole
+from misc import ManoGeneratorError, constantLabel, paramLabel
 from objs import *
 
 
-BUFFER = []
-SERIAL = 0
-OPTIMIZED_MODE = True
+# Longest inline multiplication by a constant, in instructions, that is
+# emitted under optimize instead of a call to mul.
+MAX_MULTIPLY = 32
+
+
+# Largest array or string that is copied or printed with unrolled code rather
+# than a loop or a runtime call, by optimization level: True for -O, 2 for -O2
+# and 's' for -Os.
+UNROLL = {
+  True: 4,
+  2: 16,
+  's': 0,
+}
+
+# Comparisons that generate_branch computes from the difference of their
+# operands: the instruction that skips the jump past the conditional statement
+# when the comparison holds (None for !=, which takes two jumps), and whether
+# the difference is exact or one less. The lib.txt routines of the same
+# comparisons test the same differences.
+BRANCHES = {
+  '==': ('SZA', True),
+  '!=': (None, True),
+  '<':  ('SNA', True),
+  '>=': ('SPA', True),
+  '<=': ('SNA', False),
+  '>':  ('SPA', False),
+}
+
+
+def read_names(line):
+  # Names whose value a line reads.
+  names = [line.condition]
+  if isinstance(line, (PrintLine, ReturnLine)):
+    names.append(line.target)
+  elif isinstance(line, AssignLine):
+    names.append(line.index)
+    exp = line.expression
+    if isinstance(exp, Identifier):
+      names.extend((exp.name, exp.index))
+    elif isinstance(exp, Call):
+      names.extend(exp.arguments)
+    elif isinstance(exp, UnaryOperation):
+      names.append(exp.operand)
+    elif isinstance(exp, BinaryOperation):
+      names.extend((exp.left, exp.right))
+  return [i for i in names if i is not None]
 
 
 class AsmLine(object):
-  def __init__(self, label, instruction, target, indirect, comment):
+  # source is the (function, statement, source line) the line was generated
+  # for, where statement is the index of the statement in the code of the
+  # function, or None for the rest of the function.
+  __slots__ = ('label', 'instruction', 'target', 'indirect', 'comment',
+               'source')
+
+  def __init__(self, label, instruction, target, indirect, comment,
+               source=None):
     self.label = label
     self.instruction = instruction
     self.target = target
     self.indirect = indirect
     self.comment = comment
-
-
-def genName(prefix='id'):
-  global SERIAL
-  name = prefix[:3] + '%03d' % SERIAL
-  SERIAL += 1
-  return name
-
-
-def emit(instruction, label=None, comment=None):
-  if instruction:
-    parts = instruction.split()
-    if len(parts) == 3:
-      (instruction, target) = parts[:2]
-      indirect = True
-    elif len(parts) == 2:
-      (instruction, target) = parts
-      indirect = False
-    else:
-      instruction = parts[0]
-      target = None
-      indirect = False
-
-    line = AsmLine(label, instruction, target, indirect, comment)
-
-    if OPTIMIZED_MODE and BUFFER:
-      lastLine = BUFFER[-1]
-      if lastLine.instruction == 'NOP' and line.label is None:
-        line.label = lastLine.label
-        BUFFER.pop()
-      elif (lastLine.instruction == 'BSA' and
-            lastLine.target == 'push' and
-            lastLine.indirect == False and
-            line.instruction == 'BSA' and
-            line.target == 'pop' and
-            line.indirect == False):
-        BUFFER.pop()
-        return
-      elif (lastLine.instruction == 'STA' and
-            line.instruction == 'LDA' and
-            lastLine.target == line.target and
-            lastLine.indirect == line.indirect):
-        BUFFER.pop()
-        return
-    BUFFER.append(line)
-  elif not OPTIMIZED_MODE:
-    BUFFER.append(None)  # Empty line.
-
-
-def concatenate(buffer):
-  for i in xrange(len(buffer)):
-    if buffer[i]:
-      if buffer[i].instruction == 'NOP':
-        buffer[i].instruction = 'CLE'
-        if not buffer[i].comment:
-          buffer[i].comment = 'NOP'
-
-      if buffer[i].label:
-        line = '%-11s %3s %-6s %s' % (buffer[i].label+',',
-                        buffer[i].instruction,
-                        buffer[i].target or '',
-                        'I' if buffer[i].indirect else ' ')
+    self.source = source
+
+
+def generate_program(functionset, optimize=False):
+  return Generator(optimize).generate_program(functionset)
+
+
+def generate_stream(functions, outfile, optimize=False):
+  Generator(optimize).generate_stream(functions, outfile)
+
+
+class Generator(object):
+  # In namespaced mode generated labels are prefixed with the name of the
+  # function they belong to and numbered from zero in each function, so a
+  # function's code does not depend on what was generated before it.
+  #
+  # Functions in direct (see analyser.direct_functions) take their arguments
+  # in their parameters and their return address in their first word, so
+  # calls to them do not go through the stack. Their parameters must have
+  # been collapsed in direct mode.
+  #
+  # If table is a list, a (line, function, statement, source line) tuple is
+  # appended to it for every line of output with a source (see AsmLine),
+  # counting lines from 1 over everything concatenated.
+  def __init__(self, optimize=False, namespaced=False, direct=(), table=None):
+    self.optimize = optimize
+    self.direct = direct
+    # Label of the return address of the direct function being generated.
+    self.entry = None
+    # Labels of the elements of local arrays of the current function accessed
+    # at a constant index under optimize, by (array, index).
+    self.elements = {}
+    self.unroll = UNROLL.get(optimize, 0)
+    self.namespaced = namespaced
+    self.namespace = None
+    self.buffer = []
+    self.serial = 0
+    # Label of the code or data that the pointer word labeled with the name of
+    # a function or array refers to.
+    self.labels = {}
+    # Pooled constants (see collapser.Collapser) used by the functions
+    # generated so far, by label.
+    self.pool = {}
+    # Labels of the current function that only serve conditions, and hits of
+    # each peephole rule under optimize.
+    self.removable = set()
+    self.hits = {}
+    # Lines each function was generated as, and left with by the peephole
+    # optimizer, by name, and the times each rewrite of the generator under
+    # optimize applied.
+    self.sizes = {}
+    self.rewrites = {}
+    # Source of the lines emitted, and lines concatenated so far.
+    self.source = None
+    self.table = table
+    self.lines = 0
+
+  def genName(self, prefix='id'):
+    name = prefix[:3] + '%03d' % self.serial
+    self.serial += 1
+    if self.namespace:
+      name = '%s_%s' % (self.namespace, name)
+    return name
+
+  def rewrite(self, name):
+    self.rewrites[name] = self.rewrites.get(name, 0) + 1
+
+  def emit(self, instruction, label=None, comment=None):
+    if instruction:
+      # Mnemonics and targets repeat on most lines, so share one copy of each.
+      parts = map(intern, instruction.split())
+      if len(parts) == 3:
+        (instruction, target) = parts[:2]
+        indirect = True
+      elif len(parts) == 2:
+        (instruction, target) = parts
+        indirect = False
       else:
-        line = (' ' * 12) + '%3s %-6s %s' % (buffer[i].instruction,
-                           buffer[i].target or '',
-                           'I' if buffer[i].indirect else ' ')
-
-      if buffer[i].comment and not OPTIMIZED_MODE:
-        line = line + ' ;' + buffer[i].comment
-
-      buffer[i] = line
-    else:
-      buffer[i] = ''
-
-  return '\n'.join(buffer) + '\n'
-
-
-def generate_program(functionset):
-  if not (isinstance(functionset, dict) and functionset.has_key('main')):
-    raise ManoGeneratorError, 'Program contains no "main" function.'
-
-  global BUFFER, SERIAL
-
-  BUFFER = []
-  SERIAL = 0
-
-  # Entry point.
-  emit('ORG 0', comment='Entry point')
-  emit('LDA main')
-  emit('BSA push')
-  emit('BSA call')
-  emit('HLT')
-
-  for k in functionset:
-    emit('')
-    emit('')
-    generate_function(k, functionset[k])
-
-  return concatenate(BUFFER)
-
-
-def generate_function(name, func):
-  generate_vars(func)
-  emit('')
-
-  funcname = genName('fnc')
-  # AddressOf actual function
-  emit('AND %s' % funcname, name, 'Address of %s' % name)
-  # Just for the label.
-  emit('NOP', funcname, 'Function %s' % name)
-
-  emit('BSA pop', comment='Getting return address')
-  emit('STA temp1')
-  for varname in reversed(func.params):
-    emit('BSA pop', comment='Processing arg %s' % varname)
-    emit('STA %s' % varname)
-  emit('LDA temp1')
-  emit('BSA push', comment='Putting return address back')
-
-  generate_code(func)
+        instruction = parts[0]
+        target = None
+        indirect = False
+
+      self.buffer.append(AsmLine(label, instruction, target, indirect, comment,
+                                 self.source))
+    elif not self.optimize:
+      self.buffer.append(None)  # Empty line.
+
+  def concatenate(self, buffer):
+    if self.table is not None:
+      for i in xrange(len(buffer)):
+        if buffer[i] and buffer[i].source:
+          self.table.append((self.lines + i + 1,) + buffer[i].source)
+    self.lines += len(buffer)
+
+    for i in xrange(len(buffer)):
+      if buffer[i]:
+        if buffer[i].instruction == 'NOP':
+          buffer[i].instruction = 'CLE'
+          if not buffer[i].comment:
+            buffer[i].comment = 'NOP'
+
+        if buffer[i].label:
+          line = '%-11s %3s %-6s %s' % (buffer[i].label+',',
+                          buffer[i].instruction,
+                          buffer[i].target or '',
+                          'I' if buffer[i].indirect else ' ')
+        else:
+          line = (' ' * 12) + '%3s %-6s %s' % (buffer[i].instruction,
+                             buffer[i].target or '',
+                             'I' if buffer[i].indirect else ' ')
 
+        if buffer[i].comment and not self.optimize:
+          line = line + ' ;' + buffer[i].comment
 
-def generate_vars(func):
-  for varname in sorted(func.vars.keys()):
-    (type, value) = func.vars[varname]
-    if type.name == 'WORD':
-      emit('DEC %d' % (value or 0), varname)
-    else:
-      if varname in func.params:
-        comment  = 'PARAM: '
+        buffer[i] = line
       else:
-        comment  = ''
-
-      if value:
-        comment += '%s[%d] %s = %s' % (type.name, type.size, varname, repr(value))
+        buffer[i] = ''
+
+    return '\n'.join(buffer) + '\n'
+
+  def generate_program(self, functionset):
+    if not (isinstance(functionset, dict) and functionset.has_key('main')):
+      raise ManoGeneratorError, 'Program contains no "main" function.'
+
+    self.serial = 0
+    self.pool = {}
+
+    fragments = []
+    for k in functionset:
+      fragments.append(self.generate_fragment(k, functionset[k]))
+
+    return self.link(fragments)
+
+  def generate_stream(self, functions, outfile):
+    # Writes out each function as soon as it is generated, so only the buffer of
+    # a single function is held in memory at any time.
+    self.serial = 0
+    self.pool = {}
+
+    outfile.write(self.link([], {}))
+
+    for k, func in functions:
+      outfile.write(self.concatenate(self.generate_fragment(k, func)))
+
+    self.buffer = []
+    if self.pool:
+      self.generate_pool(self.pool)
+      outfile.write(self.concatenate(self.buffer))
+      self.buffer = []
+
+  def generate_fragment(self, name, func):
+    # Generates the code of a single function into a buffer of its own.
+    self.buffer = []
+
+    if self.namespaced:
+      self.namespace = name
+      self.serial = 0
+
+    self.emit('')
+    self.emit('')
+    self.removable = set()
+    self.source = (name, None, None)
+    self.generate_function(name, func)
+    self.source = None
+
+    emitted = len(self.buffer) - self.buffer.count(None)
+    if self.optimize:
+      peephole.optimize(self.buffer, self.removable, self.hits)
+    self.sizes[name] = (emitted, len(self.buffer) - self.buffer.count(None))
+
+    return self.buffer
+
+  def link(self, fragments, pool=None):
+    # Pool defaults to the constants used by the fragments of this generator.
+    if pool is None:
+      pool = self.pool
+
+    self.buffer = []
+    self.generate_header()
+
+    for fragment in fragments:
+      self.buffer.extend(fragment)
+
+    self.generate_pool(pool)
+
+    return self.concatenate(self.buffer)
+
+  def generate_header(self):
+    # Entry point.
+    self.emit('ORG 0', comment='Entry point')
+    self.emit('LDA main')
+    self.emit('BSA push')
+    self.emit('BSA call')
+    self.emit('HLT')
+
+  def generate_function(self, name, func):
+    self.elements = self.constant_elements(func) if self.optimize else {}
+    self.generate_vars(func)
+    self.emit('')
+
+    if name in self.direct:
+      self.entry = name
+      self.emit('HEX 0', name, 'Function %s, return address' % name)
+      self.generate_code(func)
+      self.entry = None
+      return
+
+    funcname = self.genName('fnc')
+    self.labels[name] = funcname
+    # AddressOf actual function
+    self.emit('AND %s' % funcname, name, 'Address of %s' % name)
+    # Just for the label.
+    self.emit('NOP', funcname, 'Function %s' % name)
+
+    self.emit('BSA pop', comment='Getting return address')
+    self.emit('STA temp1')
+    for varname in reversed(func.params):
+      self.emit('BSA pop', comment='Processing arg %s' % varname)
+      self.emit('STA %s' % varname)
+    self.emit('LDA temp1')
+    self.emit('BSA push', comment='Putting return address back')
+
+    self.generate_code(func)
+
+  def generate_pool(self, pool):
+    if pool:
+      self.emit('')
+      self.emit('')
+
+    for label in sorted(pool):
+      (type, value) = pool[label]
+      if type.name == 'WORD':
+        self.emit('DEC %d' % value, label)
       else:
-        comment += '%s[%d] %s' % (type.name, type.size, varname)
-
-      if value:
+        comment = 'CONST: %s[%d] = %s' % (type.name, type.size, repr(value))
         value = [ord(i) for i in value]
 
-      actualName = genName('var')
-
-      emit('AND %s' % actualName, varname, comment)
-      emit('DEC %d' % (value[0] if value else 0), actualName)
+        self.emit('AND kd%s' % label[2:], label, comment)
+        self.emit('DEC %d' % (value[0] if value else 0), 'kd%s' % label[2:])
+        for i in xrange(1, type.size):
+          self.emit('DEC %d' % (value[i] if len(value) > i else 0))
+
+  def generate_vars(self, func):
+    for varname in sorted(func.vars.keys()):
+      (type, value) = func.vars[varname]
+      if value is not None and varname == constantLabel(type, value):
+        # Emitted once for the whole program by generate_pool.
+        self.pool[varname] = (type, value)
+        if type.name != 'WORD':
+          self.labels[varname] = 'kd%s' % varname[2:]
+      elif type.name == 'WORD':
+        self.emit('DEC %d' % (value or 0), varname)
+      else:
+        if varname in func.params:
+          comment  = 'PARAM: '
+        else:
+          comment  = ''
 
-      for i in xrange(1,type.size):
-        if value and len(value) > i:
-          emit('DEC %d' % value[i])
+        if value:
+          comment += '%s[%d] %s = %s' % (type.name, type.size, varname, repr(value))
         else:
-          emit('DEC 0')
-
-
-def generate_code(func):
-  for codeline in func.code:
-    condName = None
-    if codeline.condition:
-      condStart = genName('cnd')
-      condEnd = genName('skp')
-
-      emit('LDA %s' % codeline.condition, comment='condition: %s' % codeline.condition)
-      emit('SZA')
-      emit('BUN %s' % condStart)
-      emit('BUN %s' % condEnd)
-      emit('NOP', condStart)
-
-    if isinstance(codeline, GotoLine):
-      emit('BUN %s' % codeline.target, codeline.label, 'GOTO %s' % codeline.target)
-    elif isinstance(codeline, PrintLine):
-      generate_print(func, codeline)
-    elif isinstance(codeline, ReadLine):
-      raise ManoGeneratorError, 'ReadLine not implemented yet.'
-    elif isinstance(codeline, ReturnLine):
-      generate_return(func, codeline)
-    elif isinstance(codeline, AssignLine):
-      generate_assign(func, codeline)
+          comment += '%s[%d] %s' % (type.name, type.size, varname)
+
+        if value:
+          value = [ord(i) for i in value]
+
+        actualName = self.genName('var')
+        if varname not in func.params:
+          self.labels[varname] = actualName
+
+        self.emit('AND %s' % actualName, varname, comment)
+        self.emit('DEC %d' % (value[0] if value else 0), actualName)
+        if (varname, 0) in self.elements:
+          self.elements[varname, 0] = actualName
+
+        for i in xrange(1,type.size):
+          label = None
+          if (varname, i) in self.elements:
+            label = self.elements[varname, i] = '%se%d' % (actualName, i)
+
+          if value and len(value) > i:
+            self.emit('DEC %d' % value[i], label)
+          else:
+            self.emit('DEC 0', label)
+
+  def constant_elements(self, func):
+    # Elements of local arrays and strings that are accessed at a constant
+    # index, and can be addressed by a label of their own instead of through
+    # the pointer to their data. Parameters point to data elsewhere, and
+    # pooled constants are emitted by generate_pool.
+    elements = {}
+    for line in func.code:
+      if not isinstance(line, AssignLine):
+        continue
+
+      accesses = [(line.target, line.index)]
+      if isinstance(line.expression, Identifier):
+        accesses.append((line.expression.name, line.expression.index))
+
+      for name, index in accesses:
+        value = self.constant(func, index)
+        if value is None or name in func.params:
+          continue
+        (type, initial) = func.vars[name]
+        if initial is None or name != constantLabel(type, initial):
+          elements[name, value] = None
+
+    return elements
+
+  def generate_code(self, func):
+    fused = self.fused_conditions(func) if self.optimize else {}
+    function = self.source[0]
+
+    for i, codeline in enumerate(func.code):
+      self.source = (function, i, codeline.lineno)
+      if i + 1 in fused:
+        # Evaluated by the condition of the next line instead.
+        if codeline.label:
+          self.emit('NOP', codeline.label)
+        continue
+
+      condName = None
+      if codeline.condition:
+        condStart = self.genName('cnd')
+        condEnd = self.genName('skp')
+        self.removable.update((condStart, condEnd))
+
+        if i in fused:
+          self.rewrite('fused-condition')
+          self.generate_branch(func, fused[i], condStart, condEnd)
+        else:
+          self.emit('LDA %s' % codeline.condition, comment='condition: %s' % codeline.condition)
+          self.emit('SZA')
+          self.emit('BUN %s' % condStart)
+          self.emit('BUN %s' % condEnd)
+          self.emit('NOP', condStart)
+
+      if isinstance(codeline, GotoLine):
+        self.emit('BUN %s' % codeline.target, codeline.label, 'GOTO %s' % codeline.target)
+      elif isinstance(codeline, PrintLine):
+        self.generate_print(func, codeline)
+      elif isinstance(codeline, ReadLine):
+        raise ManoGeneratorError, 'ReadLine not implemented yet.'
+      elif isinstance(codeline, ReturnLine):
+        self.generate_return(func, codeline)
+      elif isinstance(codeline, AssignLine):
+        self.generate_assign(func, codeline)
+      else:
+        pass
+
+
+      if codeline.condition:
+        self.emit('NOP', condEnd)
+
+      self.emit('')
+
+    self.source = (function, None, None)
+
+  def fused_conditions(self, func):
+    # Conditions that can be computed from the expression assigned to them on
+    # the line before, by line, for WORD variables that are not read anywhere
+    # else. Their value is then never stored.
+    code = func.code
+    candidates = {}
+    for i in xrange(1, len(code)):
+      line = code[i]
+      previous = code[i-1]
+      if (line.condition and line.label is None and
+          isinstance(previous, AssignLine) and
+          previous.target == line.condition and previous.index is None and
+          previous.condition is None and
+          func.vars[previous.target][0].name == 'WORD'):
+        candidates[i] = previous.expression
+
+    reads = {}
+    for line in code:
+      for name in read_names(line):
+        reads[name] = reads.get(name, 0) + 1
+    covered = {}
+    for i in candidates:
+      name = code[i].condition
+      covered[name] = covered.get(name, 0) + 1
+
+    return dict((i, candidates[i]) for i in candidates
+                if reads[code[i].condition] == covered[code[i].condition])
+
+  def generate_branch(self, func, expression, condStart, condEnd):
+    # Jumps to condEnd unless expression is true, without storing its value.
+    if (isinstance(expression, BinaryOperation) and
+        expression.operator in BRANCHES):
+      (skip, exact) = BRANCHES[expression.operator]
+
+      # left - right, or left - right - 1 (that is, left + ~right) if not exact.
+      self.emit('LDA %s' % expression.right)
+      self.emit('CMA')
+      if exact:
+        self.emit('INC')
+      self.emit('ADD %s' % expression.left)
+      if skip:
+        self.emit(skip)
+        self.emit('BUN %s' % condEnd)
+        return
     else:
-      pass
-
-
-    if codeline.condition:
-      emit('NOP', condEnd)
-
-    emit('')
-
-
-def generate_print(func, codeline):
-  if codeline.target:
-    type, junk = func.vars[codeline.target]
-
-    if type.name == 'WORD':
-      emit('LDA %s' % codeline.target, codeline.label, 'PRINT word %s' % codeline.target)
-      emit('BSA outdec')
-    elif type.name == 'STRING':
-      emit('LDA %s' % codeline.target, codeline.label, 'PRINT string %s' % codeline.target)
-      emit('BSA push')
-      emit('BSA outstr')
-    elif type.name == 'ARRAY':
-      emit('LDA %s' % codeline.target, codeline.label, 'PRINT array %s' % codeline.target)
-      emit('STA temp1')
-      for i in xrange(type.size):
-        emit('LDA temp1 I')
-        emit('BSA outdec')
-        emit('LDA chrspc')
-        emit('BSA outchr')
-        emit('ISZ temp1', comment='Always > 0 so just a memory INC')
-      emit('BSA outnln')
+      self.generate_expression(func, expression)
+
+    self.emit('SZA')
+    self.emit('BUN %s' % condStart)
+    self.emit('BUN %s' % condEnd)
+    self.emit('NOP', condStart)
+
+  def generate_print(self, func, codeline):
+    if codeline.target:
+      type, junk = func.vars[codeline.target]
+
+      if type.name == 'WORD':
+        self.emit('LDA %s' % codeline.target, codeline.label, 'PRINT word %s' % codeline.target)
+        self.emit('BSA outdec')
+      elif type.name == 'STRING':
+        self.emit('LDA %s' % codeline.target, codeline.label, 'PRINT string %s' % codeline.target)
+        self.emit('BSA push')
+        self.emit('BSA outstr')
+      elif type.name == 'ARRAY' and self.optimize and type.size > self.unroll:
+        size = constantLabel(Type('WORD'), type.size)
+        self.pool[size] = (Type('WORD'), type.size)
+
+        self.emit('LDA %s' % size, codeline.label, 'PRINT array %s' % codeline.target)
+        self.emit('BSA push')
+        self.emit('LDA %s' % codeline.target)
+        self.emit('BSA outarr')
+      elif type.name == 'ARRAY':
+        self.emit('LDA %s' % codeline.target, codeline.label, 'PRINT array %s' % codeline.target)
+        self.emit('STA temp1')
+        for i in xrange(type.size):
+          self.emit('LDA temp1 I')
+          self.emit('BSA outdec')
+          self.emit('LDA chrspc')
+          self.emit('BSA outchr')
+          self.emit('ISZ temp1', comment='Always > 0 so just a memory INC')
+        self.emit('BSA outnln')
+      else:
+        raise ManoGeneratorError, 'Unrecognized type in PRINT sentence.'
     else:
-      raise ManoGeneratorError, 'Unrecognized type in PRINT sentence.'
-  else:
-    emit('BSA outnln', codeline.label, 'Print new line')
-
-
-def generate_return(func, codeline):
-  emit('BSA pop', codeline.label, comment='RETURN %s' % (codeline.target or ''))
-  emit('STA temp1')
-
-  emit('LDA %s' % (codeline.target or 'null'))
-  emit('BSA push')
-
-  emit('BUN temp1 I')
-
-
-def generate_assign(func, codeline):
-  if codeline.target:
-    comment  = '{%s} %s' % (func.vars[codeline.target][0], codeline.target)
-    if codeline.index is not None:
-      comment += '[' + codeline.index + ']'
-    comment += ' = '
-  else:
-    comment = ''
-  comment += str(codeline.expression)
+      self.emit('BSA outnln', codeline.label, 'Print new line')
+
+  def generate_return(self, func, codeline):
+    if self.entry:
+      self.emit('LDA %s' % (codeline.target or 'null'), codeline.label,
+                'RETURN %s' % (codeline.target or ''))
+      self.emit('BUN %s I' % self.entry)
+      return
+
+    self.emit('BSA pop', codeline.label, comment='RETURN %s' % (codeline.target or ''))
+    self.emit('STA temp1')
+
+    self.emit('LDA %s' % (codeline.target or 'null'))
+    if not self.optimize:
+      self.emit('BSA push')
+
+    self.emit('BUN temp1 I')
+
+  def generate_assign(self, func, codeline):
+    if codeline.target:
+      comment  = '{%s} %s' % (func.vars[codeline.target][0], codeline.target)
+      if codeline.index is not None:
+        comment += '[' + codeline.index + ']'
+      comment += ' = '
+    else:
+      comment = ''
+    comment += str(codeline.expression)
 
 
-  emit('NOP', codeline.label, comment)
+    self.emit('NOP', codeline.label, comment)
 
-  generate_expression(func, codeline.expression)
+    self.generate_expression(func, codeline.expression)
 
-  if codeline.target:
-    if codeline.index is None:
-      if func.vars[codeline.target][0].name == 'WORD':
-        emit('BSA pop')
-        emit('STA %s' % codeline.target)
+    if self.optimize:
+      self.generate_store(func, codeline)
+    elif codeline.target:
+      if codeline.index is None:
+        if func.vars[codeline.target][0].name == 'WORD':
+          self.emit('BSA pop')
+          self.emit('STA %s' % codeline.target)
+        else:
+          self.emit('LDA %s' % codeline.target)
+          self.emit('STA temp1')
+          self.emit('BSA pop')
+          self.emit('STA temp2')
+
+          for i in xrange(func.vars[codeline.target][0].size):
+            self.emit('LDA temp2 I')
+            self.emit('STA temp1 I')
+            self.emit('ISZ temp1', comment='Always > 0 so just a memory INC')
+            self.emit('ISZ temp2', comment='Always > 0 so just a memory INC')
       else:
-        emit('LDA %s' % codeline.target)
-        emit('STA temp1')
-        emit('BSA pop')
-        emit('STA temp2')
-
-        for i in xrange(func.vars[codeline.target][0].size):
-          emit('LDA temp2 I')
-          emit('STA temp1 I')
-          emit('ISZ temp1', comment='Always > 0 so just a memory INC')
-          emit('ISZ temp2', comment='Always > 0 so just a memory INC')
+        #Calculate effective address
+        self.emit('LDA %s' % codeline.target)
+        self.emit('ADD %s' % codeline.index)
+        self.emit('STA temp1')
+
+        #Assign
+        self.emit('BSA pop')
+        self.emit('STA temp1 I')
     else:
+      self.emit('BSA pop')
+
+  def generate_store(self, func, codeline):
+    # Stores the value of an expression from AC, under optimize.
+    if not codeline.target:
+      return
+
+    type = func.vars[codeline.target][0]
+    element = self.elements.get(
+        (codeline.target, self.constant(func, codeline.index)))
+    if element:
+      self.rewrite('constant-index')
+      self.emit('STA %s' % element)
+    elif codeline.index is not None:
+      self.emit('STA temp2')
+
       #Calculate effective address
-      emit('LDA %s' % codeline.target)
-      emit('ADD %s' % codeline.index)
-      emit('STA temp1')
+      self.emit('LDA %s' % codeline.target)
+      self.emit('ADD %s' % codeline.index)
+      self.emit('STA temp1')
 
       #Assign
-      emit('BSA pop')
-      emit('STA temp1 I')
-  else:
-    emit('BSA pop')
-
-
-def generate_expression(func, expression):
-  if isinstance(expression, Identifier):
-    generate_exp_identifier(func, expression)
-  elif isinstance(expression, Call):
-    generate_exp_call(func, expression)
-  elif isinstance(expression, UnaryOperation):
-    generate_exp_unary(func, expression)
-  elif isinstance(expression, BinaryOperation):
-    generate_exp_binary(func, expression)
-  else:
-    raise ManoGeneratorError, 'Unrecognized expression type in assignment sentence.'
-
-
-def generate_exp_identifier(func, expression):
-  if expression.index is None:
-
-    emit('LDA %s' % expression.name)
-    emit('BSA push')
-  else:
-    #Calculate effective address
-    emit('LDA %s' % expression.name)
-    emit('ADD %s' % expression.index)
-    emit('STA temp1')
-
-    #Return value
-    emit('LDA temp1 I')
-    emit('BSA push')
-
-
-def generate_exp_call(func, expression):
-  for arg in expression.arguments:
-    emit('LDA %s' % arg)
-    emit('BSA push')
-
-  emit('LDA %s' % expression.function)
-  emit('BSA push')
-  emit('BSA call')
-
-
-def generate_exp_unary(func, expression):
-  if expression.operator == '-':
-    emit('LDA %s' % expression.operand)
-    emit('BSA neg')
-    emit('BSA push')
-  elif expression.operator == '~':
-    emit('LDA %s' % expression.operand)
-    emit('CMA')
-    emit('BSA push')
-  else:
-    raise ManoGeneratorError, 'Unrecognized unary operand in assignment sentence.'
-
-
-
-def generate_exp_binary(func, expression):
-  if expression.operator == '+':
-    emit('LDA %s' % expression.left)
-    emit('ADD %s' % expression.right)
-    emit('BSA push')
-  elif expression.operator == '-':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA sub')
-    emit('BSA push')
-  elif expression.operator == '*':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA mul')
-    emit('BSA push')
-  elif expression.operator == '/':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA div')
-    emit('BSA push')
-  elif expression.operator == '%':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA mod')
-    emit('BSA push')
-  elif expression.operator == '&':
-    emit('LDA %s' % expression.left)
-    emit('AND %s' % expression.right)
-    emit('BSA push')
-  elif expression.operator == '|':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA or')
-    emit('BSA push')
-  elif expression.operator == '^':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA xor')
-    emit('BSA push')
-  elif expression.operator == '<<':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA shftl')
-    emit('BSA push')
-  elif expression.operator == '>>':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA shftr')
-    emit('BSA push')
-  elif expression.operator == '==':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA equal')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  elif expression.operator == '!=':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA nequal')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  elif expression.operator == '<':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA less')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  elif expression.operator == '<=':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA lesseq')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  elif expression.operator == '>':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA more')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  elif expression.operator == '>=':
-    emit('LDA %s' % expression.right)
-    emit('BSA push')
-    emit('LDA %s' % expression.left)
-    emit('BSA moreeq')
-    emit('CLA')
-    emit('CIL')
-    emit('BSA push')
-  else:
-    raise ManoGeneratorError, 'Unrecognized binary operand in assignment sentence.'
-
-
+      self.emit('LDA temp2')
+      self.emit('STA temp1 I')
+    elif type.name == 'WORD':
+      self.emit('STA %s' % codeline.target)
+    else:
+      self.emit('STA temp2')
+      self.emit('LDA %s' % codeline.target)
+      self.emit('STA temp1')
+      self.generate_copy(type.size)
+
+  def generate_copy(self, size):
+    # Copies size words from temp2 I to temp1 I, in a loop counted in temp4
+    # above the unrolling threshold.
+    if size > self.unroll:
+      count = constantLabel(Type('WORD'), -size)
+      self.pool[count] = (Type('WORD'), -size)
+      loop = self.genName('cpy')
+
+      self.emit('LDA %s' % count)
+      self.emit('STA temp4')
+      self.emit('LDA temp2 I', loop)
+      self.emit('STA temp1 I')
+      self.emit('ISZ temp1', comment='Always > 0 so just a memory INC')
+      self.emit('ISZ temp2', comment='Always > 0 so just a memory INC')
+      self.emit('ISZ temp4')
+      self.emit('BUN %s' % loop)
+      return
+
+    for i in xrange(size):
+      self.emit('LDA temp2 I')
+      self.emit('STA temp1 I')
+      self.emit('ISZ temp1', comment='Always > 0 so just a memory INC')
+      self.emit('ISZ temp2', comment='Always > 0 so just a memory INC')
+
+  def generate_result(self):
+    # Expressions leave their value on the stack, or in AC under optimize.
+    # Calls do the same through the return convention of generate_return.
+    if not self.optimize:
+      self.emit('BSA push')
+
+  def generate_expression(self, func, expression):
+    if isinstance(expression, Identifier):
+      self.generate_exp_identifier(func, expression)
+    elif isinstance(expression, Call):
+      self.generate_exp_call(func, expression)
+    elif isinstance(expression, UnaryOperation):
+      self.generate_exp_unary(func, expression)
+    elif isinstance(expression, BinaryOperation):
+      self.generate_exp_binary(func, expression)
+    else:
+      raise ManoGeneratorError, 'Unrecognized expression type in assignment sentence.'
+
+  def generate_exp_identifier(self, func, expression):
+    element = self.elements.get(
+        (expression.name, self.constant(func, expression.index)))
+    if expression.index is None:
+
+      self.emit('LDA %s' % expression.name)
+      self.generate_result()
+    elif element:
+      self.rewrite('constant-index')
+      self.emit('LDA %s' % element)
+    else:
+      #Calculate effective address
+      self.emit('LDA %s' % expression.name)
+      self.emit('ADD %s' % expression.index)
+      self.emit('STA temp1')
+
+      #Return value
+      self.emit('LDA temp1 I')
+      self.generate_result()
+
+  def generate_exp_call(self, func, expression):
+    if expression.function in self.direct:
+      self.rewrite('direct-call')
+      for i, arg in enumerate(expression.arguments):
+        self.emit('LDA %s' % arg)
+        self.emit('STA %s' % paramLabel(expression.function, i))
+      self.emit('BSA %s' % expression.function)
+      return
+
+    for arg in expression.arguments:
+      self.emit('LDA %s' % arg)
+      self.emit('BSA push')
+
+    self.emit('LDA %s' % expression.function)
+    self.emit('BSA push')
+    self.emit('BSA call')
+
+  def generate_exp_unary(self, func, expression):
+    if expression.operator == '-' and self.optimize:
+      self.emit('LDA %s' % expression.operand)
+      self.emit('CMA')
+      self.emit('INC')
+    elif expression.operator == '-':
+      self.emit('LDA %s' % expression.operand)
+      self.emit('BSA neg')
+      self.generate_result()
+    elif expression.operator == '~':
+      self.emit('LDA %s' % expression.operand)
+      self.emit('CMA')
+      self.generate_result()
+    else:
+      raise ManoGeneratorError, 'Unrecognized unary operand in assignment sentence.'
+
+  def constant(self, func, name):
+    # The value of name if it is a pooled WORD constant, None otherwise.
+    (type, value) = func.vars.get(name, (None, None))
+    if (value is None or type.name != 'WORD' or
+        name != constantLabel(type, value)):
+      return None
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+  def generate_shift(self, instruction, count):
+    for i in xrange(count):
+      self.emit('CLE')
+      self.emit(instruction)
+
+  def generate_negate(self):
+    self.emit('CMA')
+    self.emit('INC')
+
+  def generate_multiply(self, name, value):
+    # Shift-and-add over the bits of value, highest first. Returns False if
+    # the sequence would be longer than MAX_MULTIPLY instructions.
+    bits = bin(abs(value))[3:] if value else ''
+    if 1 + 2 * len(bits) + bits.count('1') + 2 > MAX_MULTIPLY:
+      return False
+
+    if value == 0:
+      self.emit('CLA')
+      return True
+
+    self.emit('LDA %s' % name)
+    for bit in bits:
+      self.generate_shift('CIL', 1)
+      if bit == '1':
+        self.emit('ADD %s' % name)
+    if value < 0:
+      self.generate_negate()
+    return True
+
+  def generate_divide(self, name, shift):
+    # Division by 2**shift, rounding towards zero like div.
+    positive = self.genName('pos')
+    end = self.genName('end')
+    self.removable.update((positive, end))
+
+    self.emit('LDA %s' % name)
+    self.emit('SNA')
+    self.emit('BUN %s' % positive)
+    self.generate_negate()
+    self.generate_shift('CIR', shift)
+    self.generate_negate()
+    self.emit('BUN %s' % end)
+    self.emit('CLE', positive)
+    self.emit('CIR')
+    self.generate_shift('CIR', shift - 1)
+    self.emit('NOP', end)
+
+  def generate_modulo(self, name, shift):
+    # Remainder of |name| by 2**shift, like mod.
+    mask = (1 << shift) - 1
+    label = constantLabel(Type('WORD'), mask)
+    self.pool[label] = (Type('WORD'), mask)
+    positive = self.genName('pos')
+    self.removable.add(positive)
+
+    self.emit('LDA %s' % name)
+    self.emit('SNA')
+    self.emit('BUN %s' % positive)
+    self.generate_negate()
+    self.emit('AND %s' % label, positive)
+
+  def generate_exp_constant(self, func, expression):
+    # Inline code for operations with a constant operand, under optimize.
+    # Returns False if there is none and the generic code must be used.
+    (op, left, right) = (expression.operator, expression.left, expression.right)
+    lvalue = self.constant(func, left)
+    rvalue = self.constant(func, right)
+    if lvalue is None and rvalue is None:
+      return False
+
+    if op in ('+', '|', '^') and (lvalue == 0 or rvalue == 0):
+      self.emit('LDA %s' % (right if lvalue == 0 else left))
+    elif op == '-' and rvalue == 0:
+      self.emit('LDA %s' % left)
+    elif op == '-' and lvalue == 0:
+      self.emit('LDA %s' % right)
+      self.generate_negate()
+    elif op == '&' and (lvalue == 0 or rvalue == 0):
+      self.emit('CLA')
+    elif op == '&' and (lvalue == -1 or rvalue == -1):
+      self.emit('LDA %s' % (right if lvalue == -1 else left))
+    elif op == '*':
+      # Either constant may give the shorter sequence.
+      if rvalue is not None and self.generate_multiply(left, rvalue):
+        return True
+      return lvalue is not None and self.generate_multiply(right, lvalue)
+    elif rvalue is None:
+      # The other operations need a constant on the right.
+      return False
+    elif op == '/' and rvalue in (1, -1):
+      self.emit('LDA %s' % left)
+      if rvalue == -1:
+        self.generate_negate()
+    elif op == '/' and rvalue > 1 and rvalue & (rvalue - 1) == 0:
+      self.generate_divide(left, len(bin(rvalue)) - 3)
+    elif op == '%' and rvalue in (1, -1):
+      self.emit('CLA')
+    elif op == '%' and rvalue != 0 and abs(rvalue) & (abs(rvalue) - 1) == 0:
+      self.generate_modulo(left, len(bin(abs(rvalue))) - 3)
+    elif op in ('<<', '>>') and rvalue >= 16:
+      self.emit('CLA')
+    elif op in ('<<', '>>') and rvalue > 0:
+      # The runtime routines also shift zeroes in. Counts below 1 are left
+      # to them, as they do not return the operand for those.
+      self.emit('LDA %s' % left)
+      self.generate_shift('CIL' if op == '<<' else 'CIR', rvalue)
+    else:
+      return False
+
+    return True
+
+  def generate_exp_binary(self, func, expression):
+    if self.optimize and self.generate_exp_constant(func, expression):
+      self.rewrite('constant-operand')
+      return
+
+    if expression.operator == '+':
+      self.emit('LDA %s' % expression.left)
+      self.emit('ADD %s' % expression.right)
+      self.generate_result()
+    elif expression.operator == '-' and self.optimize:
+      # left + ~right + 1, without passing right on the stack.
+      self.emit('LDA %s' % expression.right)
+      self.emit('CMA')
+      self.emit('INC')
+      self.emit('ADD %s' % expression.left)
+    elif expression.operator == '-':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA sub')
+      self.generate_result()
+    elif expression.operator == '*':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA mul')
+      self.generate_result()
+    elif expression.operator == '/':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA div')
+      self.generate_result()
+    elif expression.operator == '%':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA mod')
+      self.generate_result()
+    elif expression.operator == '&':
+      self.emit('LDA %s' % expression.left)
+      self.emit('AND %s' % expression.right)
+      self.generate_result()
+    elif expression.operator == '|':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA or')
+      self.generate_result()
+    elif expression.operator == '^':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA xor')
+      self.generate_result()
+    elif expression.operator == '<<':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA shftl')
+      self.generate_result()
+    elif expression.operator == '>>':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA shftr')
+      self.generate_result()
+    elif expression.operator == '==':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA equal')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    elif expression.operator == '!=':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA nequal')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    elif expression.operator == '<':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA less')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    elif expression.operator == '<=':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA lesseq')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    elif expression.operator == '>':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA more')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    elif expression.operator == '>=':
+      self.emit('LDA %s' % expression.right)
+      self.emit('BSA push')
+      self.emit('LDA %s' % expression.left)
+      self.emit('BSA moreeq')
+      self.emit('CLA')
+      self.emit('CIL')
+      self.generate_result()
+    else:
+      raise ManoGeneratorError, 'Unrecognized binary operand in assignment sentence.'
@@ -0,0 +1,326 @@
+#!/usr/bin/python2
+
+import argparse
+import sys
+import mparser
+import analyser
+import compiler
+import runtime
+import simulator
+from misc import ManoInterpreterError
+from objs import *
+
+
+# Mask of a word.
+WORD = 0xFFFF
+# Optimization levels compare compiles programs at, and their flags.
+LEVELS = [(False, ''), (True, '-O'), ('s', '-Os'), (2, '-O2')]
+# Instructions the simulator may execute per statement interpreted before
+# compare gives up on a compiled program.
+INSTRUCTIONS = 10000
+
+
+def signed(word):
+  return word - 0x10000 if word & 0x8000 else word
+
+
+def divide(left, right):
+  # Rounded towards zero, and 0 when dividing by 0, like div.
+  if not right:
+    return 0
+  quotient = abs(signed(left)) // abs(signed(right))
+  if (left ^ right) & 0x8000:
+    quotient = -quotient
+  return quotient & WORD
+
+
+def modulo(left, right):
+  # Of the absolute values, and 0 when dividing by 0, like mod.
+  if not right:
+    return 0
+  return (abs(signed(left)) % abs(signed(right))) & WORD
+
+
+def shift(left, right, operator):
+  # Counts from 1 to 32768 shift zeroes in. Like shftl and shftr, any other
+  # count returns its negation rather than the operand.
+  count = -right & WORD
+  if not count & 0x8000:
+    return count
+  if right >= 16:
+    return 0
+  return (left << right if operator == '<<' else left >> right) & WORD
+
+
+# Binary operators, as the runtime routines the generator calls for them
+# compute them. Comparisons test the sign of the difference of their operands,
+# or of the difference minus one, which may overflow.
+BINARY = {
+  '+':  lambda a, b: (a + b) & WORD,
+  '-':  lambda a, b: (a - b) & WORD,
+  '*':  lambda a, b: (a * b) & WORD,
+  '/':  divide,
+  '%':  modulo,
+  '&':  lambda a, b: a & b,
+  '|':  lambda a, b: a | b,
+  '^':  lambda a, b: a ^ b,
+  '<<': lambda a, b: shift(a, b, '<<'),
+  '>>': lambda a, b: shift(a, b, '>>'),
+  '==': lambda a, b: int(a == b),
+  '!=': lambda a, b: int(a != b),
+  '<':  lambda a, b: int(bool((a - b) & 0x8000)),
+  '<=': lambda a, b: int(bool((a - b - 1) & 0x8000)),
+  '>':  lambda a, b: int(not (a - b - 1) & 0x8000),
+  '>=': lambda a, b: int(not (a - b) & 0x8000),
+}
+UNARY = {
+  '-': lambda a: -a & WORD,
+  '~': lambda a: a ^ WORD,
+}
+
+
+class Frame(object):
+  # A call in progress: the function, its variables, the next statement and
+  # the statement of the caller that receives the value returned.
+  __slots__ = ('name', 'function', 'variables', 'next', 'caller')
+
+  def __init__(self, name, function, variables, caller):
+    self.name = name
+    self.function = function
+    self.variables = variables
+    self.next = 0
+    self.caller = caller
+
+
+class Interpreter(object):
+  # Runs a parsed and analysed program statement by statement, computing with
+  # words as the compiled program and the runtime library do, and collects
+  # its output in self.output. Like the generated code, every function keeps
+  # its variables in a single place for the whole run, which recursive calls
+  # share. WORD variables hold their value, arrays and strings the list of
+  # their words, which parameters share with the arguments passed to them.
+  #
+  # What the compiled program would do is unknown for some programs, like
+  # those that index past the end of an array: those raise
+  # ManoInterpreterError instead.
+  def __init__(self, functionset):
+    self.functions = functionset
+    self.variables = {}
+    self.labels = {}
+    for funcname, func in functionset.items():
+      self.variables[funcname] = self.allocate(func)
+      self.labels[funcname] = dict((line.label, i)
+                                   for i, line in enumerate(func.code)
+                                   if line.label)
+
+    self.frames = [Frame('main', functionset['main'],
+                         self.variables['main'], None)]
+    self.output = []
+    self.steps = 0
+    self.halted = False
+
+    self.visitors = {
+      GotoLine: self.visit_goto,
+      PrintLine: self.visit_print,
+      ReadLine: self.visit_read,
+      ReturnLine: self.visit_return,
+      AssignLine: self.visit_assign,
+    }
+
+  def allocate(self, func):
+    variables = {}
+    for varname, (typ, value) in func.vars.items():
+      if typ.name == 'WORD':
+        variables[varname] = (value or 0) & WORD
+      else:
+        words = [0] * typ.size
+        if typ.name == 'STRING' and value:
+          value = [ord(i) for i in value]
+        for i, word in enumerate(value or ()):
+          words[i] = word & WORD
+        variables[varname] = words
+
+    return variables
+
+  def run(self, limit=None):
+    # Executes statements until main returns, or until limit of them have
+    # been executed. Returns whether the program ended.
+    frames = self.frames
+    visitors = self.visitors
+    steps = 0
+    end = -1 if limit is None else limit
+
+    try:
+      while frames and steps != end:
+        frame = frames[-1]
+        code = frame.function.code
+        if frame.next == len(code):
+          # Like RETURN, which main usually ends without.
+          self.leave(0)
+          continue
+
+        line = code[frame.next]
+        frame.next += 1
+        steps += 1
+        if line.condition and not frame.variables[line.condition]:
+          continue
+        visitors[type(line)](frame, line)
+    finally:
+      self.steps += steps
+
+    self.halted = not frames
+    return self.halted
+
+  def error(self, frame, line, msg):
+    return ManoInterpreterError('In function %s: %s' % (frame.name, msg),
+                                line.lineno)
+
+  def element(self, frame, line, name, index):
+    words = frame.variables[name]
+    index = frame.variables[index]
+    if index >= len(words):
+      raise self.error(frame, line, 'Index %d out of bounds for %s of size %d.'
+                                    % (signed(index), name, len(words)))
+    return words, index
+
+  def store(self, frame, line, value):
+    # Stores the value of the expression of an assignment, or returned by a
+    # function.
+    if line.target is None:
+      return
+
+    variables = frame.variables
+    if line.index is not None:
+      (words, index) = self.element(frame, line, line.target, line.index)
+      words[index] = value
+    elif isinstance(value, list):
+      words = variables[line.target]
+      words[:] = value[:len(words)]
+    else:
+      variables[line.target] = value
+
+  def leave(self, value):
+    frame = self.frames.pop()
+    if frame.caller is not None:
+      self.store(self.frames[-1], frame.caller, value)
+
+  def visit_goto(self, frame, line):
+    frame.next = self.labels[frame.name][line.target]
+
+  def visit_print(self, frame, line):
+    if line.target is None:
+      self.output.append('\n')
+      return
+
+    value = frame.variables[line.target]
+    typ = frame.function.vars[line.target][0]
+    if typ.name == 'WORD':
+      self.output.append(str(signed(value)))
+    elif typ.name == 'STRING':
+      # Up to the first null word, like outstr.
+      if 0 not in value:
+        raise self.error(frame, line, 'String %s is not terminated.' %
+                                      line.target)
+      self.output.append(''.join(chr(i & 0xFF)
+                                 for i in value[:value.index(0)]))
+    else:
+      self.output.append(''.join('%d ' % signed(i) for i in value) + '\n')
+
+  def visit_read(self, frame, line):
+    raise self.error(frame, line, 'READ is not supported.')
+
+  def visit_return(self, frame, line):
+    # RETURN null returns 0, like RETURN without a value.
+    if line.target is None or line.target == 'null':
+      self.leave(0)
+    else:
+      self.leave(frame.variables[line.target])
+
+  def visit_assign(self, frame, line):
+    exp = line.expression
+    variables = frame.variables
+    if isinstance(exp, BinaryOperation):
+      value = BINARY[exp.operator](variables[exp.left], variables[exp.right])
+    elif isinstance(exp, Identifier):
+      if exp.index is None:
+        value = variables[exp.name]
+      else:
+        (words, index) = self.element(frame, line, exp.name, exp.index)
+        value = words[index]
+    elif isinstance(exp, UnaryOperation):
+      value = UNARY[exp.operator](variables[exp.operand])
+    else:
+      self.call(frame, line, exp)
+      return
+
+    self.store(frame, line, value)
+
+  def call(self, frame, line, exp):
+    func = self.functions[exp.function]
+    variables = self.variables[exp.function]
+    arguments = [frame.variables[i] for i in exp.arguments]
+    for param, argument in zip(func.params, arguments):
+      variables[param] = argument
+    self.frames.append(Frame(exp.function, func, variables, line))
+
+
+def load(text):
+  fset = mparser.parse_program(text)
+  analyser.analyse_program(fset)
+  return Interpreter(fset)
+
+
+def run(text, limit=None):
+  # Runs the program in text, and returns the interpreter.
+  interpreter = load(text)
+  interpreter.run(limit)
+  return interpreter
+
+
+def compare(text, limit=None):
+  # Runs the program in text in the interpreter and, compiled at every
+  # optimization level, in the simulator. Returns the interpreter, and the flag
+  # of each level whose output differs from it.
+  interpreter = run(text, limit)
+  if not interpreter.halted:
+    return interpreter, []
+
+  with open(runtime.LIBRARY) as source:
+    library = (runtime.LIBRARY, source.read())
+  expected = ''.join(interpreter.output)
+  differ = []
+  for level, flag in LEVELS:
+    program = compiler.Compiler(level).compile_source(text)
+    machine = simulator.run([library, ('program', program)],
+                            INSTRUCTIONS * (interpreter.steps + 1))[0]
+    if not machine.halted or ''.join(machine.output) != expected:
+      differ.append(flag or 'no -O')
+
+  return interpreter, differ
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='interpreter')
+  parser.add_argument('--steps', type=int, metavar='N',
+                      help='stop after N statements')
+  parser.add_argument('--compare', action='store_true',
+                      help='also compile the program at every optimization '
+                           'level, and check that the simulator prints the '
+                           'same')
+  parser.add_argument('source_file')
+  args = parser.parse_args()
+
+  with open(args.source_file) as source:
+    text = source.read()
+  if args.compare:
+    (interpreter, differ) = compare(text, args.steps)
+  else:
+    (interpreter, differ) = (run(text, args.steps), [])
+
+  sys.stdout.write(''.join(interpreter.output))
+  if not interpreter.halted:
+    sys.stderr.write('Stopped after %d statements.\n' % interpreter.steps)
+  for flag in differ:
+    sys.stderr.write('Compiled with %s, the program prints something else.\n'
+                     % flag)
+  sys.exit(0 if interpreter.halted and not differ else 1)
@@ -1,5 +1,6 @@
+import hashlib
 import re
-import tokenize
+from cStringIO import StringIO
 
 
 RESERVED  = ['FUNC', 'END', 'RETURN', 'RETURNS', 'PRINT', 'READ', 'GOTO',
@@ -9,17 +10,61 @@ BINARY_OPS= ['-', '+', '/', '*', '%', '&', '|', '^', '<<', '>>', '==', '!=',
              '>', '>=', '<', '<=']
 RE_IDENTIFIER = re.compile('^[A-Za-z][A-Za-z0-9_]*$')
 RE_STRING = re.compile(r'''^"([^"]|\")*"|'([^']|\')*'$''')
-CURLINE = 1
-
-
-class ManoParserError(Exception):
-  def __init__(msg):
-    Exception.__init__(self, 'Line %d: %s' % (CURLINE, msg))
+RE_TOKEN = re.compile(r'''
+    \#[^\r\n]*                          # Comment.
+  | "(?:[^"\\\r\n]|\\.)*"                # Double-quoted string.
+  | '(?:[^'\\\r\n]|\\.)*'                # Single-quoted string.
+  | 0[xX][0-9A-Fa-f]+[lL]? | \d+[lLjJ]?  # Number.
+  | [A-Za-z_]\w*                        # Name.
+  | <<=?|>>=?|\*\*=?|//=?|<>|!=          # Multi-character operators.
+  | [-+*/%&|^=<>]=? | ~                 # Single-character operators.
+  | \S                                  # Anything else, one at a time.
+''', re.VERBOSE)
+
+
+class ManoLineError(Exception):
+  # An error at a line of the input, if known.
+  def __init__(self, msg, line=None):
+    Exception.__init__(self, msg)
+    self.msg = msg
+    self.line = line
+
+  def __reduce__(self):
+    # Keeps the line when raised in a worker process.
+    return (type(self), (self.msg, self.line))
+
+  def __str__(self):
+    if self.line is None:
+      return self.msg
+    else:
+      return 'Line %d: %s' % (self.line, self.msg)
+class ManoParserError(ManoLineError):
+  pass
 class ManoGeneratorError(Exception):
   pass
 class ManoCollapserError(Exception):
   pass
 class ManoAnalyserError(Exception):
+  def __init__(self, msg, line=None, function=None, statement=None):
+    Exception.__init__(self, msg)
+    self.msg = msg
+    self.line = line
+    self.function = function
+    self.statement = statement
+
+  def __reduce__(self):
+    return (type(self), (self.msg, self.line, self.function, self.statement))
+
+  def __str__(self):
+    out = self.msg
+    if self.function is not None:
+      out = 'In function %s: %s' % (self.function, out)
+    if self.line is not None:
+      out = 'Line %d: %s' % (self.line, out)
+    return out
+class ManoAssemblerError(ManoLineError):
+  pass
+class ManoInterpreterError(ManoLineError):
   pass
 
 
@@ -49,68 +94,69 @@ def isValueOfType(value, type):
     return False
 
 
-class tokenizer(object):
-  def __init__(self, text):
-    self.finished = False
-    self._curline = 1
-    self._gen = tokenize.generate_tokens(self._lines(text).next)
-    self._line = []
-
-    self._endnext = False
-    self._nextline= []
+def constantLabel(type, value):
+  # Label of the cell holding a constant in the program-wide constant pool.
+  # It only depends on the constant, so identical constants share one cell
+  # even when their functions are compiled separately.
+  if type.name == 'WORD':
+    return 'kw%d' % value if value >= 0 else 'kwn%d' % -value
+  else:
+    return 'ks' + hashlib.md5(value).hexdigest()[:8]
 
-    self.peek()
 
-    global CURLINE
-    CURLINE = 1
+def paramLabel(function, index):
+  # Label of a parameter of a function that callers may store arguments into
+  # directly (see collapser.Collapser).
+  return '%sp%d' % (function, index)
 
-  def _lines(self, text):
-    start = 0
 
-    for i in xrange(len(text)):
-      if text[i] == '\n':
-        if text[start:i] and not text[start:i].isspace(): yield text[start:i]
-        start = i+1
+class tokenizer(object):
+  # Reads lazily from a string or any iterable of lines (e.g. an open file),
+  # yielding one list of tokens per non-blank line. curline is the number of
+  # the last line read, counting from the curline passed in for the first line
+  # of text, and its source text is kept in rawline.
+  def __init__(self, text, curline=1):
+    if isinstance(text, basestring):
+      text = StringIO(text)
 
-    yield text[start:]
+    self.finished = False
+    self.curline = curline
+    self.rawline = None
+    self._source = iter(text)
+    self._lineno = curline - 1
+    self._nextraw = None
+    self._nextlineno = curline
+    self._nextline = self._readline()
+
+  def _readline(self):
+    for line in self._source:
+      self._lineno += 1
+      tokens = RE_TOKEN.findall(line)
+      if tokens:
+        self._nextraw = line
+        self._nextlineno = self._lineno
+        return tokens
+
+    self._nextlineno = self._lineno
+    return None
 
   def read(self):
-    line = self._nextline
-    self._nextline = []
+    line = self._nextline or []
+    self.rawline = self._nextraw
+    self.curline = self._nextlineno
+    self._nextline = self._readline()
 
-    self.peek()
-    if self._endnext:
+    if self._nextline is None:
       self.finished = True
 
-    global CURLINE
-    CURLINE += 1
-
     return line
 
   def peek(self):
-    if self._nextline:
-      return self._nextline
-
     if self.finished:
-      raise ManoParserError, 'No lines remaining.'
-
-    for i in self._gen:
-      if self._curline != i[2][0]:
-        self._curline += 1
-        line = self._line
-
-        if i[1] and not i[1].isspace():
-          self._line = [i[1]]
-        else:
-          self._line = []
+      raise ManoParserError('No lines remaining.', self.curline)
 
-        self._nextline = line
-
-        return line
-
-      if i[1] and not i[1].isspace(): self._line.append(i[1])
-
-    self._endnext = True
+    return self._nextline
 
   def __nonzero__(self):
     return not self.finished
+
@@ -3,32 +3,124 @@ from misc import ManoParserError, isValidIdentifier, isValueOfType, tokenizer, U
 
 def parse_program(text):
   functions = {}
-  tokenlist = tokenizer(text)
 
-  try:
-    while tokenlist:
-      func = Function()
+  for funcname, func in iter_program(text, names=functions):
+    functions[funcname] = func
+
+  return functions
 
+
+def iter_program(text, curline=1, names=None):
+  # A function whose name is already in names, if given, is reported as a
+  # duplicate at its FUNC line.
+  tokenlist = tokenizer(text, curline)
+
+  while tokenlist:
+    func = Function()
+
+    try:
       funcname = parse_func_head(tokenlist, func)
+      if names is not None and funcname in names:
+        raise ManoParserError('Duplicate function declaration.',
+                              tokenlist.curline)
       parse_vars(tokenlist, func)
       parse_code(tokenlist, func)
 
-      func.addCodeLine(ReturnLine())
-
       key = tokenlist.read()
       if key != ['END']:
         raise ManoParserError('No END found after function header.')
 
-      functions[funcname] = func
-  except:
-    raise
+      code = ReturnLine()
+      code.lineno = tokenlist.curline
+      func.addCodeLine(code)
+    except ManoParserError, e:
+      if e.line is None:
+        e.line = tokenlist.curline
+      raise
 
-  return functions
+    yield funcname, func
+
+
+def parse_signatures(text, calls=None):
+  # If calls is a dictionary, the names of the functions each function may call
+  # (see line_calls) are added to it.
+  signatures = {}
+  tokenlist = tokenizer(text)
+  funcname = None
+
+  while tokenlist:
+    line = tokenlist.read()
+
+    if line and line[0] == 'FUNC':
+      func = Function()
+      try:
+        funcname = parse_func_header(line, func)
+      except ManoParserError, e:
+        if e.line is None:
+          e.line = tokenlist.curline
+        raise
+
+      if funcname in signatures:
+        raise ManoParserError('Duplicate function declaration.',
+                              tokenlist.curline)
+
+      signatures[funcname] = func.signature()
+      if calls is not None:
+        calls[funcname] = set()
+    elif calls is not None and funcname is not None:
+      calls[funcname].update(line_calls(line))
+
+  return signatures
+
+
+def line_calls(line):
+  # Names followed by an opening parenthesis in a line of tokens, which include
+  # every function the line calls.
+  return [line[i] for i in xrange(len(line) - 1)
+          if line[i+1] == '(' and isValidIdentifier(line[i])]
+
+
+def split_program(text, calls=None):
+  # Yields the name, signature, source text and starting line of each function
+  # without parsing its body. calls is filled as by parse_signatures.
+  tokenlist = tokenizer(text)
+
+  while tokenlist:
+    line = tokenlist.read()
+    start = tokenlist.curline
+
+    func = Function()
+    try:
+      funcname = parse_func_header(list(line), func)
+    except ManoParserError, e:
+      if e.line is None:
+        e.line = tokenlist.curline
+      raise
+
+    source = [tokenlist.rawline.rstrip('\r\n')]
+    if calls is not None:
+      calls[funcname] = set()
+
+    while line != ['END']:
+      if not tokenlist:
+        raise ManoParserError('No END found after function header.',
+                              tokenlist.curline)
+      line = tokenlist.read()
+      if calls is not None:
+        calls[funcname].update(line_calls(line))
+      # Blank lines keep their place, so line numbers within the block match
+      # the whole program.
+      source.extend([''] * (tokenlist.curline - start - len(source)))
+      source.append(tokenlist.rawline.rstrip('\r\n'))
+
+    yield funcname, func.signature(), '\n'.join(source), start
 
 
 def parse_func_head(tokenlist, func):
-  line = tokenlist.read()
+  return parse_func_header(tokenlist.read(), func)
 
+
+def parse_func_header(line, func):
   try:
     key = line.pop(0)
     if key != 'FUNC':
@@ -36,7 +128,6 @@ def parse_func_head(tokenlist, func):
 
     name = line.pop(0)
     if not isValidIdentifier(name):
-      print name
       raise ManoParserError('Invalid function name.')
 
     key = line.pop(0)
@@ -160,6 +251,7 @@ def parse_code(tokenlist, func):
     except IndexError:
       raise ManoParserError('Error parsing statement.')
 
+    code.lineno = tokenlist.curline
     func.addCodeLine(code)
     label = None
 
@@ -247,10 +339,13 @@ def parse_type(tokens):
 def parse_number(tokens):
   num = tokens.pop(0)
 
-  if num.startswith('0x'):
-    num = int(num, 16)
-  else:
-    num = int(num)
+  try:
+    if num.startswith('0x'):
+      num = int(num, 16)
+    else:
+      num = int(num)
+  except ValueError:
+    raise ManoParserError('Invalid numeric literal %s.' % num)
 
   if num <= 0xffff:
     return num
@@ -2,19 +2,36 @@ from misc import ManoParserError, isValidIdentifier, isValueOfType, UNARY_OPS, B
 
 
 class Type(object):
-  def __init__(self, name, size=None):
+  # Types are immutable and interned, so Type('WORD') always returns the same
+  # object and types can be compared by identity.
+  __slots__ = ('name', 'size')
+
+  interned = {}
+
+  def __new__(cls, name, size=None):
     if name == 'WORD':
-      self.name = name
-      self.size = 1
+      size = 1
     elif name in ('STRING', 'ARRAY'):
-      if size is not None and size > 0:
-        self.name = name
-        self.size = size
-      else:
+      if size is None or size <= 0:
         raise ManoParserError('Invalid var size.')
     else:
       raise ManoParserError('Invalid type.')
 
+    typ = cls.interned.get((name, size))
+    if typ is None:
+      typ = object.__new__(cls)
+      object.__setattr__(typ, 'name', name)
+      object.__setattr__(typ, 'size', size)
+      typ = cls.interned.setdefault((name, size), typ)
+    return typ
+
+  def __setattr__(self, name, value):
+    raise AttributeError('Type objects are immutable.')
+
+  def __reduce__(self):
+    # Unpickled types are interned again.
+    return (Type, (self.name, self.size))
+
   def __repr__(self):
     if self.name == 'WORD':
       return self.name
@@ -30,13 +47,16 @@ class Type(object):
     return not self.__eq__(other)
 
   def __hash__(self):
-    return hash(self.name + str(Self.size))
+    return hash((self.name, self.size))
 
 
 class CodeLine(object):
+  __slots__ = ('label', 'condition', 'lineno')
+
   def __init__(self, label, condition):
     self.label = label
     self.condition = condition
+    self.lineno = None  # Source line, set by the parser.
 
   def __repr__(self):
     out = ''
@@ -47,6 +67,8 @@ class CodeLine(object):
     return out
 
 class GotoLine(CodeLine):
+  __slots__ = ('target',)
+
   def __init__(self, target, label=None, condition=None):
     if not isValidIdentifier(target):
       raise ManoParserError('Invalid identifier in goto statement.')
@@ -58,6 +80,8 @@ class GotoLine(CodeLine):
     return '%s GOTO %s' % (CodeLine.__repr__(self), self.target)
 
 class PrintLine(CodeLine):
+  __slots__ = ('target',)
+
   def __init__(self, target=None, label=None, condition=None):
     if target and not isValidIdentifier(target):
       raise ManoParserError('Invalid identifier in print statement.')
@@ -69,6 +93,8 @@ class PrintLine(CodeLine):
     return '%s PRINT %s' % (CodeLine.__repr__(self), self.target or '(New line)')
 
 class ReadLine(CodeLine):
+  __slots__ = ('target',)
+
   def __init__(self, target, label=None, condition=None):
     if not isValidIdentifier(target):
       raise ManoParserError('Invalid identifier in read statement.')
@@ -80,6 +106,8 @@ class ReadLine(CodeLine):
     return '%s READ %s' % (CodeLine.__repr__(self), self.target)
 
 class ReturnLine(CodeLine):
+  __slots__ = ('target',)
+
   def __init__(self, target=None, label=None, condition=None):
     if target and not isValidIdentifier(target):
       raise ManoParserError('Invalid identifier in return statement.')
@@ -91,6 +119,8 @@ class ReturnLine(CodeLine):
     return '%s RETURN %s' % (CodeLine.__repr__(self), self.target or '(None)')
 
 class AssignLine(CodeLine):
+  __slots__ = ('target', 'index', 'expression')
+
   def __init__(self, target, expression, index=None, label=None, condition=None):
     if target and not isValidIdentifier(target):
       raise ManoParserError('Invalid identifier in assignment statement.')
@@ -109,10 +139,12 @@ class AssignLine(CodeLine):
 
 
 class Expression(object):
-  pass
+  __slots__ = ()
 
 
 class Call(Expression):
+  __slots__ = ('function', 'arguments')
+
   def __init__(self, function, arguments):
     if not isValidIdentifier(function):
       raise ManoParserError('Invalid function identifier in call expression.')
@@ -130,6 +162,8 @@ class Call(Expression):
     return '%s(%s)' % (self.function, ', '.join(self.arguments))
 
 class Identifier(Expression):
+  __slots__ = ('name', 'index')
+
   def __init__(self, name, index=None):
     if not isValidIdentifier(name):
       raise ManoParserError('Invalid base identifier name.')
@@ -146,6 +180,8 @@ class Identifier(Expression):
       return self.name
 
 class UnaryOperation(Expression):
+  __slots__ = ('operator', 'operand')
+
   def __init__(self, operator, operand):
     if operator not in UNARY_OPS:
       raise ManoParserError('Invalid unary operator.')
@@ -159,6 +195,8 @@ class UnaryOperation(Expression):
     return '%s%s' % (self.operator, self.operand)
 
 class BinaryOperation(Expression):
+  __slots__ = ('operator', 'left', 'right')
+
   def __init__(self, operator, left, right):
     if operator not in BINARY_OPS:
       raise ManoParserError('Invalid binary operator.')
@@ -176,10 +214,11 @@ class BinaryOperation(Expression):
 
 
 class Function(object):
+  __slots__ = ('params', 'vars', 'return_type', 'code')
+
   def __init__(self):
     self.params = []
     self.vars   = {}
-    self.consts = {}
 
     self.return_type = None
 
@@ -235,6 +274,9 @@ class Function(object):
 
     self.vars[name] = (typ, value)
 
+  def signature(self):
+    return (self.return_type, [self.vars[i][0] for i in self.params])
+
   def __repr__(self):
     out = []
     out.append('(%s) -> %s' % (', '.join(self.params), self.return_type))
@@ -0,0 +1,291 @@
+from collections import defaultdict
+
+
+# Instructions that may skip the next one, which is then only executed
+# conditionally.
+SKIPS = set(['SZA', 'SNA', 'SPA', 'SZE', 'ISZ', 'SKI', 'SKO'])
+# Instructions after which the next line is only reached through its label.
+JUMPS = set(['BUN', 'HLT'])
+# Pseudo-instructions for data.
+DATA = set(['DEC', 'HEX'])
+# Instructions that set AC without reading it or changing anything else.
+LOADS = set(['LDA', 'CLA'])
+# Instructions that neither use the stack nor read E, nor branch.
+STRAIGHT = set(['LDA', 'ADD', 'AND', 'STA', 'CLA', 'CMA', 'INC'])
+# Cell that rule_spill keeps values in instead of the stack.
+SPILL = 'temp3'
+
+
+def asm(instruction, target=None, indirect=False):
+  # Imported here, as the generator imports this module.
+  from generator import AsmLine
+  return AsmLine(None, instruction, target, indirect, None)
+
+
+def same_operand(a, b):
+  return a.target == b.target and a.indirect == b.indirect
+
+
+def rule_nop(lines, peephole):
+  # NOP        ->
+  if lines[0].instruction == 'NOP':
+    return []
+
+
+def rule_push_pop(lines, peephole):
+  # BSA push   ->
+  # BSA pop
+  (push, pop) = lines
+  if (push.instruction == 'BSA' and push.target == 'push' and
+      not push.indirect and
+      pop.instruction == 'BSA' and pop.target == 'pop' and not pop.indirect):
+    return []
+
+
+def rule_store_load(lines, peephole):
+  # STA x      -> STA x
+  # LDA x
+  (store, load) = lines
+  if (store.instruction == 'STA' and load.instruction == 'LDA' and
+      same_operand(store, load)):
+    return [store]
+
+
+def rule_load_store(lines, peephole):
+  # LDA x      -> LDA x
+  # STA x
+  (load, store) = lines
+  if (load.instruction == 'LDA' and store.instruction == 'STA' and
+      same_operand(load, store)):
+    return [load]
+
+
+def rule_store_store(lines, peephole):
+  # STA x      -> STA x
+  # STA x
+  (first, second) = lines
+  if (first.instruction == 'STA' and second.instruction == 'STA' and
+      same_operand(first, second)):
+    return [first]
+
+
+def rule_spill(lines, peephole):
+  # BSA push   -> STA temp3
+  # ...           ...
+  # BSA pop       LDA temp3
+  if lines[0].instruction != 'BSA' or lines[0].target != 'push':
+    return None
+
+  for j in xrange(1, len(lines)):
+    line = lines[j]
+    if line.label is not None:
+      return None
+    if line.instruction == 'BSA' and line.target == 'pop' and j > 1:
+      return ([asm('STA', SPILL)] + lines[1:j] + [asm('LDA', SPILL)] +
+              lines[j+1:])
+    if line.instruction not in STRAIGHT or line.target == SPILL:
+      return None
+
+
+def rule_dead_load(lines, peephole):
+  # LDA x      -> LDA y
+  # LDA y
+  (first, second) = lines
+  if first.instruction in LOADS and second.instruction in LOADS:
+    return [second]
+
+
+def rule_thread(lines, peephole):
+  # BUN a      -> BUN b
+  # ...
+  # a, BUN b
+  jump = lines[0]
+  if jump.instruction == 'BUN' and not jump.indirect:
+    target = peephole.final_target(jump.target)
+    if target is not None:
+      return [asm('BUN', target.target, target.indirect)]
+
+
+def rule_jump_next(lines, peephole):
+  # BUN a      -> a, ...
+  # a, ...
+  (jump, line) = lines
+  if (jump.instruction == 'BUN' and not jump.indirect and
+      line.label == jump.target):
+    return [line]
+
+
+def rule_unreachable(lines, peephole):
+  # BUN a      -> BUN a
+  # ...
+  (jump, line) = lines
+  if (jump.instruction in JUMPS and line.label is None and
+      line.instruction not in DATA):
+    return [jump]
+
+
+# Rewrite rules, tried in order at each line: (name, instructions the first
+# line of the window may have, smallest and largest number of lines the rule
+# looks at, rule, whether the rule also applies to a line that may be skipped).
+# A rule returns the lines to replace its window with, or None if it does not
+# match.
+RULES = [
+  ('nop',         ['NOP'],        1, 1, rule_nop,         False),
+  ('push-pop',    ['BSA'],        2, 2, rule_push_pop,    False),
+  ('store-load',  ['STA'],        2, 2, rule_store_load,  False),
+  ('load-store',  ['LDA'],        2, 2, rule_load_store,  False),
+  ('store-store', ['STA'],        2, 2, rule_store_store, False),
+  ('dead-load',   LOADS,          2, 2, rule_dead_load,   False),
+  ('spill',       ['BSA'],        3, 8, rule_spill,       False),
+  ('thread',      ['BUN'],        1, 1, rule_thread,      True),
+  ('jump-next',   ['BUN'],        2, 2, rule_jump_next,   False),
+  ('unreachable', JUMPS,          2, 2, rule_unreachable, False),
+]
+
+# The rules that may match a line, by its instruction.
+RULES_BY_INSTRUCTION = {}
+for rule in RULES:
+  for instruction in rule[1]:
+    RULES_BY_INSTRUCTION.setdefault(instruction, []).append(rule)
+
+
+def optimize(buffer, removable=(), hits=None):
+  return Peephole(buffer, removable, hits).run()
+
+
+class Peephole(object):
+  # Rewrites the buffer of a single function until no rule applies. A label
+  # may only be entered at the first line of a window: rules never remove or
+  # merge a labeled line other than the first, whose label is moved to the line
+  # that replaces it. Labels in removable (those generated for conditions) are
+  # dropped once nothing refers to them, which lets more rules apply. Hits per
+  # rule are added to hits.
+  def __init__(self, buffer, removable=(), hits=None):
+    self.buffer = buffer
+    self.removable = removable
+    self.hits = hits if hits is not None else {}
+
+    self.refs = defaultdict(int)
+    self.defs = {}
+    for line in buffer:
+      if line is not None:
+        self.add(line)
+
+  def add(self, line):
+    if line.target is not None:
+      self.refs[line.target] += 1
+    if line.label is not None:
+      self.defs[line.label] = line
+
+  def remove(self, line):
+    if line.target is not None:
+      self.refs[line.target] -= 1
+    if line.label is not None and self.defs.get(line.label) is line:
+      del self.defs[line.label]
+
+  def hit(self, name):
+    self.hits[name] = self.hits.get(name, 0) + 1
+
+  def final_target(self, label):
+    # The last jump of the chain of jumps starting at label, if any.
+    seen = set()
+    line = None
+    while label in self.defs and self.defs[label].instruction == 'BUN':
+      if label in seen:
+        return None  # Loop.
+      seen.add(label)
+      line = self.defs[label]
+      if line.indirect:
+        break
+      label = line.target
+
+    return line
+
+  def run(self):
+    changed = True
+    while changed:
+      changed = False
+      i = 0
+      while i < len(self.buffer):
+        if self.rewrite(i):
+          changed = True
+          i = max(i - 2, 0)
+        else:
+          i += 1
+
+    return self.buffer
+
+  def rewrite(self, i):
+    buffer = self.buffer
+    first = buffer[i]
+    if first is None:
+      return False
+
+    if (first.label in self.removable and not self.refs[first.label] and
+        self.defs.get(first.label) is first):
+      self.remove(first)
+      first.label = None
+      self.hit('dead-label')
+      return True
+
+    skipped = i > 0 and buffer[i-1] is not None and \
+              buffer[i-1].instruction in SKIPS
+
+    rules = RULES_BY_INSTRUCTION.get(first.instruction, ())
+    for name, instructions, smallest, largest, rule, conditional in rules:
+      if skipped and not conditional:
+        continue
+      lines = buffer[i:i+largest]
+      if len(lines) < smallest:
+        continue
+      if None in lines:
+        continue
+
+      replacement = rule(lines, self)
+      if replacement is None:
+        continue
+      if not self.replace(i, lines, replacement):
+        continue
+
+      self.hit(name)
+      return True
+
+    return False
+
+  def replace(self, i, lines, replacement):
+    # Labeled lines after the first must be kept as they are.
+    for line in lines[1:]:
+      if line.label is not None and line not in replacement:
+        return False
+
+    label = lines[0].label
+    moved = None
+    if label is not None and lines[0] not in replacement:
+      if replacement:
+        if replacement[0].label is not None:
+          return False
+        replacement[0].label = label
+      else:
+        following = self.buffer[i+len(lines)] \
+                    if i + len(lines) < len(self.buffer) else None
+        if (following is None or following.label is not None or
+            following.instruction in DATA):
+          return False
+        moved = following
+
+    # New lines come from the statement of the first.
+    for line in replacement:
+      if line.source is None:
+        line.source = lines[0].source
+
+    for line in lines:
+      self.remove(line)
+    if moved is not None:
+      self.remove(moved)
+      moved.label = label
+      self.add(moved)
+    for line in replacement:
+      self.add(line)
+
+    self.buffer[i:i+len(lines)] = replacement
+    return True
@@ -0,0 +1,164 @@
+import runtime
+import simulator
+from runtime import MEMORY
+
+
+# Clock cycles of an instruction, by the code the simulator decodes it to:
+# memory-reference instructions take from five (STA, BUN) to seven (ISZ),
+# register-reference and I/O instructions four.
+CYCLES = bytearray([6, 6, 6, 5, 5, 6, 7, 4] * 2 + [4] * 14)
+# Entries of each table of the report.
+TOP = 10
+# Function of the code that calls main and halts.
+ENTRY = '(entry)'
+
+
+class Profiler(simulator.Machine):
+  # Counts the instructions executed at each address, and their cycles. One
+  # instruction is executed at a time, so this is much slower than the other
+  # machines.
+  def __init__(self, memory):
+    simulator.Machine.__init__(self, memory)
+    self.counts = [0] * MEMORY
+    self.cycles = [0] * MEMORY
+
+  def run(self, limit=None):
+    step = simulator.Machine.run
+    (counts, cycles, codes) = (self.counts, self.cycles, self.codes)
+    while not self.halted and (limit is None or self.steps < limit):
+      pc = self.pc
+      counts[pc] += 1
+      cycles[pc] += CYCLES[codes[pc]]
+      step(self, 1)
+    return self.halted
+
+
+class Cost(object):
+  def __init__(self):
+    self.instructions = 0
+    self.cycles = 0
+
+  def add(self, instructions, cycles):
+    self.instructions += instructions
+    self.cycles += cycles
+
+
+class Profile(object):
+  # The costs of a run of a compiled program, by statement of the source
+  # (including the code of a function outside its statements, as statement
+  # None), by function and by routine of the runtime library.
+  #
+  # sources are the (name, text) sources of the program as simulator.assemble
+  # takes them, program the name of the compiled one among them, lines its
+  # line table (see compiler.Compiler.compile_source) and filename the name of
+  # the source it was compiled from.
+  def __init__(self, sources, program, lines, filename, limit=None):
+    self.filename = filename
+    with open(filename) as source:
+      self.text = source.read().split('\n')
+
+    positions = {}
+    (memory, symbols) = simulator.assemble(sources, positions)
+    self.machine = Profiler(memory)
+    self.machine.run(limit)
+
+    table = dict((i[0], i[1:]) for i in lines)
+    # First line of each function, where its code outside statements goes.
+    starts = {}
+    for function, statement, line in table.itervalues():
+      if line is not None:
+        starts[function] = min(starts.get(function, line), line)
+
+    routines = {}
+    for routine in runtime.load().routines:
+      if routine.name in symbols:
+        start = symbols[routine.name]
+        for address in xrange(start, start + routine.words):
+          routines[address] = routine.name
+
+    self.total = Cost()
+    self.statements = {}
+    self.functions = {}
+    self.routines = {}
+    # Costs by (file, function, line), for callgrind.
+    self.lines = {}
+    for address in xrange(MEMORY):
+      count = self.machine.counts[address]
+      if not count:
+        continue
+      cycles = self.machine.cycles[address]
+      self.total.add(count, cycles)
+
+      (name, lineno) = positions[address]
+      if name == program and lineno in table:
+        (function, statement, line) = table[lineno]
+        key = (function, statement, line or starts.get(function, 0))
+        self.cost(self.statements, key).add(count, cycles)
+        self.cost(self.functions, function).add(count, cycles)
+        position = (filename, function, key[2])
+      elif address in routines:
+        self.cost(self.routines, routines[address]).add(count, cycles)
+        position = (name, routines[address], lineno)
+      else:
+        position = (name, ENTRY, lineno)
+      self.cost(self.lines, position).add(count, cycles)
+
+  def cost(self, costs, key):
+    if key not in costs:
+      costs[key] = Cost()
+    return costs[key]
+
+  def report(self):
+    out = ['Profile: %d instructions, %d cycles.' % (
+        self.total.instructions, self.total.cycles)]
+    generated = sum(i.cycles for i in self.functions.itervalues())
+    library = sum(i.cycles for i in self.routines.itervalues())
+    out.append('Generated code: %s, runtime library: %s.' % (
+        self.share(generated), self.share(library)))
+
+    out.extend(self.table('Statements', 'line  function      statement',
+                          self.statements, self.describe))
+    out.extend(self.table('Functions', 'function', self.functions, str))
+    out.extend(self.table('Runtime routines', 'routine', self.routines, str))
+    return '\n'.join(out) + '\n'
+
+  def share(self, cycles):
+    return '%d cycles (%.1f%%)' % (
+        cycles, 100.0 * cycles / max(self.total.cycles, 1))
+
+  def table(self, title, heading, costs, describe):
+    out = ['', '%s:' % title,
+           '      cycles      %%  instructions  %s' % heading]
+    ranked = sorted(costs.items(), key=lambda i: (-i[1].cycles, i[0]))
+    for key, cost in ranked[:TOP]:
+      out.append('  %10d %5.1f%%  %12d  %s' % (
+          cost.cycles, 100.0 * cost.cycles / max(self.total.cycles, 1),
+          cost.instructions, describe(key)))
+    return out
+
+  def describe(self, key):
+    (function, statement, line) = key
+    if statement is None:
+      text = '(outside statements)'
+    else:
+      text = self.text[line - 1].strip() if 0 < line <= len(self.text) else ''
+    return '%4d  %-12s  %s' % (line, function, text)
+
+  def write_callgrind(self, outfile):
+    # Writes the costs by source line in the format of callgrind, for
+    # KCachegrind and the like. Costs are exclusive: calls are not recorded.
+    with open(outfile, 'w') as out:
+      out.write('version: 1\n')
+      out.write('creator: mano profiler\n')
+      out.write('positions: line\n')
+      out.write('events: Instructions Cycles\n')
+      out.write('summary: %d %d\n' % (self.total.instructions,
+                                      self.total.cycles))
+
+      current = None
+      for (name, function, line) in sorted(self.lines):
+        if (name, function) != current:
+          out.write('\nfl=%s\nfn=%s\n' % (name, function))
+          current = (name, function)
+        cost = self.lines[name, function, line]
+        out.write('%d %d %d\n' % (line, cost.instructions, cost.cycles))
@@ -0,0 +1,147 @@
+import os
+from misc import ManoGeneratorError
+
+
+# The runtime library the generated code calls into.
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib.txt')
+# Words of memory of the machine.
+MEMORY = 0x1000
+# Words of the library holding the address the stack starts at.
+STACK = ('stkdef', 'stkptr')
+# Pseudo-instructions whose operand is not a label.
+LITERALS = set(['ORG', 'DEC', 'HEX', 'END'])
+# Registers operated on by I/O instructions.
+REGISTERS = set(['AC'])
+
+
+def parse_line(line):
+  # Returns the label, instruction and target of a line of assembly, each None
+  # if missing.
+  code = line.split(';', 1)[0]
+  label = None
+  if ',' in code:
+    (label, code) = code.split(',', 1)
+    label = label.strip()
+
+  parts = code.split()
+  instruction = parts[0] if parts else None
+  target = None
+  if len(parts) > 1 and instruction not in LITERALS and \
+     parts[1] not in REGISTERS:
+    target = parts[1]
+
+  return label, instruction, target
+
+
+class Routine(object):
+  # A word of the library labeled at the start of a line, and the words after
+  # it up to the next such label: a routine with its local labels, or a
+  # constant or variable with the data following it.
+  def __init__(self, name):
+    self.name = name
+    self.lines = []
+    self.labels = set([name])
+    self.targets = set()
+    self.words = 0
+
+  def add(self, line):
+    (label, instruction, target) = parse_line(line)
+    self.lines.append(line.rstrip())
+    if label:
+      self.labels.add(label)
+    if instruction:
+      self.words += 1
+    if target:
+      self.targets.add(target)
+
+
+class Runtime(object):
+  # The routines of the library, in order. Words that are neither labeled nor
+  # follow a labeled word (the markers between sections) are not part of any
+  # routine, and are dropped.
+  def __init__(self, text):
+    self.routines = []
+    # Routine each label of the library belongs to.
+    self.owners = {}
+
+    routine = None
+    for line in text.split('\n'):
+      (label, instruction, target) = parse_line(line)
+      if instruction == 'ORG':
+        continue
+      if line[:1].strip():
+        routine = None
+        if label:
+          routine = Routine(label)
+          self.routines.append(routine)
+      if routine is not None and instruction:
+        routine.add(line)
+
+    for routine in self.routines:
+      for label in routine.labels:
+        self.owners[label] = routine
+
+  def words(self):
+    return sum(i.words for i in self.routines)
+
+  def required(self, targets):
+    # The routines that the given labels refer to, and those they call or use
+    # in turn.
+    required = set()
+    work = [self.owners[i] for i in targets if i in self.owners]
+    while work:
+      routine = work.pop()
+      if routine.name not in required:
+        required.add(routine.name)
+        work.extend(self.owners[i] for i in routine.targets
+                    if i in self.owners)
+
+    return [i for i in self.routines if i.name in required]
+
+  def link(self, lines):
+    # Returns the routines the program in lines uses, assembled at the top of
+    # memory, with the stack starting right after the program, and the number
+    # of words of the whole library they take.
+    words = 0
+    labels = set()
+    targets = set()
+    for line in lines:
+      (label, instruction, target) = parse_line(line)
+      if instruction not in (None, 'ORG', 'END'):
+        words += 1
+      labels.add(label)
+      targets.add(target)
+
+    routines = self.required(targets - labels)
+    origin = MEMORY - sum(i.words for i in routines)
+    if words > origin:
+      raise ManoGeneratorError, 'Program does not fit in memory.'
+
+    out = ['', '', 'ORG %X' % origin]
+    for routine in routines:
+      if routine.name in STACK:
+        out.append('%-13s HEX %X' % (routine.name + ',', words))
+      else:
+        out.extend(routine.lines)
+
+    return '\n'.join(out) + '\n', origin
+
+
+# Parsed on first use.
+RUNTIME = None
+
+
+def load():
+  global RUNTIME
+  if RUNTIME is None:
+    with open(LIBRARY) as library:
+      RUNTIME = Runtime(library.read())
+  return RUNTIME
+
+
+def link(lines):
+  # Returns the part of the library used by the program in lines, to be
+  # appended to it, and the number of words of the library left out.
+  runtime = load()
+  (text, origin) = runtime.link(lines)
+  return text, runtime.words() - (MEMORY - origin)
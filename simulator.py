@@ -0,0 +1,350 @@
+#!/usr/bin/python2
+
+import argparse
+import sys
+import time
+from array import array
+from misc import ManoAssemblerError
+from runtime import LIBRARY, MEMORY
+
+
+# Mask of the address part of a word.
+ADDRESS = 0xFFF
+# Memory-reference instructions, by opcode. Bit 15 of the word makes them
+# indirect.
+MRI = {'AND': 0, 'ADD': 1, 'LDA': 2, 'STA': 3, 'BUN': 4, 'BSA': 5, 'ISZ': 6}
+# Register-reference and I/O instructions, by word.
+RRI = {'CLA': 0x7800, 'CLE': 0x7400, 'CMA': 0x7200, 'CME': 0x7100,
+       'CIR': 0x7080, 'CIL': 0x7040, 'INC': 0x7020, 'SPA': 0x7010,
+       'SNA': 0x7008, 'SZA': 0x7004, 'SZE': 0x7002, 'HLT': 0x7001}
+IOI = {'INP': 0xF800, 'OUT': 0xF400, 'SKI': 0xF200, 'SKO': 0xF100,
+       'ION': 0xF080, 'IOF': 0xF040}
+
+# Codes the words of memory are decoded to: the opcode of a direct
+# memory-reference instruction, the opcode plus 8 of an indirect one, 7 and
+# 15 for any other register-reference and I/O word, and one code of its own
+# for each single register-reference instruction and for OUT and SKO, which
+# make up nearly all of them.
+(CLA, CLE, CMA, CME, CIR, CIL, INC, SPA, SNA, SZA, SZE, HLT, OUT, SKO) = \
+    range(16, 30)
+SINGLE = {0x7800: CLA, 0x7400: CLE, 0x7200: CMA, 0x7100: CME, 0x7080: CIR,
+          0x7040: CIL, 0x7020: INC, 0x7010: SPA, 0x7008: SNA, 0x7004: SZA,
+          0x7002: SZE, 0x7001: HLT, 0xF400: OUT, 0xF100: SKO}
+
+# Code of every word.
+CODES = bytearray(0x10000)
+for i in xrange(16):
+  CODES[i << 12:(i + 1) << 12] = chr(i) * 0x1000
+for i in SINGLE:
+  CODES[i] = SINGLE[i]
+
+
+def parse(text):
+  # Yields the line number, label, instruction and operands of every line of
+  # assembly with a label or an instruction.
+  for lineno, line in enumerate(text.split('\n'), 1):
+    code = line.split(';', 1)[0]
+    label = None
+    if ',' in code:
+      (label, code) = code.split(',', 1)
+      label = label.strip()
+
+    parts = code.split()
+    if label or parts:
+      yield lineno, label, parts[0] if parts else None, parts[1:]
+
+
+def assemble(sources, positions=None):
+  # Assembles the (name, text) sources in order, as if loaded one after the
+  # other, into a list of MEMORY words. Returns it, and the address of each
+  # label. If positions is a dict, the name of the source and the line number
+  # of each word are stored in it by address. No two words may be assembled
+  # at the same address.
+  memory = [0] * MEMORY
+  owners = [None] * MEMORY
+  symbols = {}
+  sources = [(name, list(parse(text))) for name, text in sources]
+
+  for name, lines in sources:
+    address = 0
+    for lineno, label, instruction, operands in lines:
+      try:
+        if instruction == 'END':
+          break
+        elif instruction == 'ORG':
+          address = int(operands[0], 16)
+          continue
+
+        if label:
+          if label in symbols:
+            raise ManoAssemblerError('Duplicate label %s.' % label, lineno)
+          symbols[label] = address
+        address += 1
+      except (IndexError, ValueError):
+        raise ManoAssemblerError('Invalid ORG in %s.' % name, lineno)
+
+  for name, lines in sources:
+    address = 0
+    for lineno, label, instruction, operands in lines:
+      if instruction == 'END':
+        break
+      elif instruction == 'ORG':
+        address = int(operands[0], 16)
+        continue
+      elif address >= MEMORY:
+        raise ManoAssemblerError('%s does not fit in memory.' % name, lineno)
+      elif owners[address] is not None:
+        raise ManoAssemblerError('%s overlaps %s at %03X.' % (
+            name, owners[address], address), lineno)
+
+      try:
+        memory[address] = encode(instruction, operands, symbols)
+      except ManoAssemblerError, e:
+        raise ManoAssemblerError('In %s: %s' % (name, e.msg), lineno)
+      owners[address] = name
+      if positions is not None:
+        positions[address] = (name, lineno)
+      address += 1
+
+  return memory, symbols
+
+
+def encode(instruction, operands, symbols):
+  if instruction in MRI:
+    if not operands:
+      raise ManoAssemblerError('Missing address for %s.' % instruction)
+    if operands[0] in symbols:
+      address = symbols[operands[0]]
+    else:
+      try:
+        address = int(operands[0], 16)
+      except ValueError:
+        raise ManoAssemblerError('Unknown label %s.' % operands[0])
+
+    word = MRI[instruction] << 12 | address & ADDRESS
+    if operands[1:2] == ['I']:
+      word |= 0x8000
+    return word
+  elif instruction in RRI:
+    return RRI[instruction]
+  elif instruction in IOI:
+    return IOI[instruction]
+  elif instruction in ('DEC', 'HEX'):
+    try:
+      return int(operands[0], 10 if instruction == 'DEC' else 16) & 0xFFFF
+    except (IndexError, ValueError):
+      raise ManoAssemblerError('Invalid %s.' % instruction)
+  elif instruction is None:
+    raise ManoAssemblerError('Missing instruction.')
+  else:
+    raise ManoAssemblerError('Unknown instruction %s.' % instruction)
+
+
+class Machine(object):
+  # A Mano machine with no input, whose output device is always ready and
+  # whose output is collected in self.output. Every word of memory is decoded
+  # once, into self.codes, when loaded or written, rather than each time it is
+  # executed.
+  def __init__(self, memory):
+    self.memory = array('H', memory)
+    self.codes = bytearray(CODES[i] for i in memory)
+    self.ac = 0
+    self.e = 0
+    self.pc = 0
+    self.output = []
+    self.steps = 0
+    self.halted = False
+
+  def run(self, limit=None):
+    # Executes instructions until HLT, or until limit of them have been
+    # executed. Returns whether the machine halted.
+    memory = self.memory
+    codes = self.codes
+    output = self.output
+    (ac, e, pc) = (self.ac, self.e, self.pc)
+    steps = 0
+    end = -1 if limit is None else limit
+
+    while steps != end:
+      word = memory[pc]
+      code = codes[pc]
+      steps += 1
+      pc = (pc + 1) & ADDRESS
+
+      # Most frequent first.
+      if code == 2:     # LDA
+        ac = memory[word & ADDRESS]
+      elif code == 3:   # STA
+        address = word & ADDRESS
+        memory[address] = ac
+        codes[address] = CODES[ac]
+      elif code == 5:   # BSA
+        address = word & ADDRESS
+        memory[address] = pc
+        codes[address] = CODES[pc]
+        pc = (address + 1) & ADDRESS
+      elif code == 12:  # BUN I
+        pc = memory[word & ADDRESS] & ADDRESS
+      elif code == 4:   # BUN
+        pc = word & ADDRESS
+      elif code == 1:   # ADD
+        ac += memory[word & ADDRESS]
+        e = ac >> 16
+        ac &= 0xFFFF
+      elif code == 6:   # ISZ
+        address = word & ADDRESS
+        value = (memory[address] + 1) & 0xFFFF
+        memory[address] = value
+        codes[address] = CODES[value]
+        if not value:
+          pc = (pc + 1) & ADDRESS
+      elif code >= 16:
+        if code == CLE:
+          e = 0
+        elif code == SZA:
+          if not ac:
+            pc = (pc + 1) & ADDRESS
+        elif code == SNA:
+          if ac & 0x8000:
+            pc = (pc + 1) & ADDRESS
+        elif code == SPA:
+          if not ac & 0x8000:
+            pc = (pc + 1) & ADDRESS
+        elif code == SZE:
+          if not e:
+            pc = (pc + 1) & ADDRESS
+        elif code == CIL:
+          (ac, e) = (((ac << 1) & 0xFFFF) | e, ac >> 15)
+        elif code == CIR:
+          (ac, e) = ((ac >> 1) | (e << 15), ac & 1)
+        elif code == CMA:
+          ac ^= 0xFFFF
+        elif code == INC:
+          ac = (ac + 1) & 0xFFFF
+        elif code == CLA:
+          ac = 0
+        elif code == CME:
+          e ^= 1
+        elif code == SKO:
+          pc = (pc + 1) & ADDRESS
+        elif code == OUT:
+          output.append(chr(ac & 0xFF))
+        else:           # HLT
+          self.halted = True
+          break
+      elif code == 0:   # AND
+        ac &= memory[word & ADDRESS]
+      elif code == 7:
+        (ac, e, pc) = self.register(word, ac, e, pc)
+        if word & 1:
+          self.halted = True
+          break
+      elif code == 15:
+        (ac, pc) = self.io(word, ac, pc)
+      else:
+        # Indirect memory-reference instructions other than BUN.
+        address = memory[word & ADDRESS] & ADDRESS
+        if code == 10:    # LDA I
+          ac = memory[address]
+        elif code == 11:  # STA I
+          memory[address] = ac
+          codes[address] = CODES[ac]
+        elif code == 9:   # ADD I
+          ac += memory[address]
+          e = ac >> 16
+          ac &= 0xFFFF
+        elif code == 8:   # AND I
+          ac &= memory[address]
+        elif code == 13:  # BSA I
+          memory[address] = pc
+          codes[address] = CODES[pc]
+          pc = (address + 1) & ADDRESS
+        else:             # ISZ I
+          value = (memory[address] + 1) & 0xFFFF
+          memory[address] = value
+          codes[address] = CODES[value]
+          if not value:
+            pc = (pc + 1) & ADDRESS
+
+    (self.ac, self.e, self.pc) = (ac, e, pc)
+    self.steps += steps
+    return self.halted
+
+  def register(self, word, ac, e, pc):
+    # Any combination of register-reference instructions, in the order the
+    # machine performs them.
+    if word & 0x800:
+      ac = 0
+    if word & 0x400:
+      e = 0
+    if word & 0x200:
+      ac ^= 0xFFFF
+    if word & 0x100:
+      e ^= 1
+    if word & 0x080:
+      (ac, e) = ((ac >> 1) | (e << 15), ac & 1)
+    if word & 0x040:
+      (ac, e) = (((ac << 1) & 0xFFFF) | e, ac >> 15)
+    if word & 0x020:
+      ac = (ac + 1) & 0xFFFF
+    if ((word & 0x010 and not ac & 0x8000) or (word & 0x008 and ac & 0x8000) or
+        (word & 0x004 and not ac) or (word & 0x002 and not e)):
+      pc = (pc + 1) & ADDRESS
+    return ac, e, pc
+
+  def io(self, word, ac, pc):
+    # Any combination of I/O instructions. There is never any input, and no
+    # interrupts.
+    if word & 0x800:
+      ac &= 0xFF00
+    if word & 0x400:
+      self.output.append(chr(ac & 0xFF))
+    if word & 0x100:
+      pc = (pc + 1) & ADDRESS
+    return ac, pc
+
+  def transcript(self):
+    # The output of the program and how it stopped, as manosim prints them.
+    if self.halted:
+      reason = 'HLT at %03X' % ((self.pc - 1) & ADDRESS)
+    else:
+      reason = 'step limit at %03X' % self.pc
+    return '%s--> Execution stopped after %d steps, due to %s\n' % (
+        ''.join(self.output), self.steps, reason)
+
+
+def load(sources):
+  return Machine(assemble(sources)[0])
+
+
+def run(sources, limit=None):
+  # Runs the (name, text) sources, as assemble loads them, and returns the
+  # machine, and the number of instructions it executed per second.
+  machine = load(sources)
+  start = time.time()
+  machine.run(limit)
+  return machine, machine.steps / max(time.time() - start, 1e-6)
+
+
+def run_files(filenames, limit=None):
+  sources = []
+  for filename in filenames:
+    with open(filename) as source:
+      sources.append((filename, source.read()))
+  return run(sources, limit)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='simulator')
+  parser.add_argument('--steps', type=int, metavar='N',
+                      help='stop after N instructions')
+  parser.add_argument('--no-lib', dest='lib', action='store_false',
+                      help='do not load lib.txt first, as for a linked program')
+  parser.add_argument('files', nargs='+')
+  args = parser.parse_args()
+
+  filenames = ([LIBRARY] if args.lib else []) + args.files
+  (machine, speed) = run_files(filenames, args.steps)
+  sys.stdout.write(machine.transcript())
+  sys.stderr.write('%.0f instructions/s\n' % speed)
+  sys.exit(0 if machine.halted else 1)
@@ -0,0 +1,57 @@
+import unittest
+import compiler
+from misc import ManoParserError
+
+
+PROGRAM = '''FUNC twice(WORD x) RETURNS WORD:
+  VARS:
+    WORD y
+  CODE:
+    y = x + x
+    RETURN y
+END
+
+FUNC main() RETURNS NONE:
+  VARS:
+    WORD a
+  CODE:
+    a = twice(%s)
+    PRINT a
+END
+'''
+
+
+class CheckTest(unittest.TestCase):
+  def test_type_errors(self):
+    errors = compiler.Compiler().check_source(PROGRAM % 'b' + '''
+FUNC other() RETURNS NONE:
+  VARS:
+    WORD a
+  CODE:
+    a = c
+END
+''')
+    self.assertEqual([str(i) for i in errors],
+                     ['Line 13: In function main: Undefined identifier b.',
+                      'Line 21: In function other: Undefined identifier c.'])
+
+  def test_syntax_error(self):
+    errors = compiler.Compiler().check_source(PROGRAM % '1 + + 2')
+    self.assertEqual(len(errors), 1)
+    self.assertTrue(isinstance(errors[0], ManoParserError))
+    self.assertEqual(errors[0].line, 13)
+
+  def test_duplicate_function(self):
+    # Reported at the second FUNC line by every way of compiling.
+    text = PROGRAM % '1' + '\n' + PROGRAM.split('\n\n')[0] + '\n'
+    for jobs in (None, 1):
+      try:
+        compiler.Compiler(jobs=jobs).compile_source(text)
+      except ManoParserError, e:
+        self.assertEqual(str(e), 'Line 17: Duplicate function declaration.')
+      else:
+        self.fail('duplicate function compiled')
+
+
+if __name__ == '__main__':
+  unittest.main()
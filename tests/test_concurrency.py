@@ -0,0 +1,38 @@
+import os
+import unittest
+from multiprocessing.pool import ThreadPool
+import compiler
+
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'resources')
+# Every optimization level, as compiler.py passes them on.
+LEVELS = (False, True, 2, 's')
+
+
+class ConcurrencyTest(unittest.TestCase):
+  def test_threads(self):
+    # Compiles each program at each level many times through one shared
+    # Compiler, interleaved on a pool of threads, and checks the output
+    # against that of serial compilations.
+    texts = []
+    for filename in ('example.txt', 'arith.txt'):
+      with open(os.path.join(RESOURCES, filename)) as source:
+        texts.append(source.read())
+    jobs = [(text, level) for text in texts for level in LEVELS] * 8
+
+    session = compiler.Compiler()
+    expected = [session.compile_source(text, level) for text, level in jobs]
+
+    pool = ThreadPool(8)
+    try:
+      results = pool.map(lambda job: session.compile_source(*job), jobs, 1)
+    finally:
+      pool.close()
+
+    for job, result, serial in zip(jobs, results, expected):
+      self.assertEqual(result, serial, 'output differs at level %r' % job[1])
+
+
+if __name__ == '__main__':
+  unittest.main()
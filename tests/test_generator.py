@@ -0,0 +1,174 @@
+import unittest
+import analyser
+import generator
+import interpreter
+import mparser
+from misc import constantLabel
+from objs import BinaryOperation, Function, Type
+
+
+class ConstantOperandTest(unittest.TestCase):
+  def multiply(self, left, right):
+    # The instructions generated for left * right, both pooled constants, or
+    # None if the generic code must be used.
+    func = Function()
+    for value in (left, right):
+      func.vars[constantLabel(Type('WORD'), value)] = (Type('WORD'), value)
+    expression = BinaryOperation('*', constantLabel(Type('WORD'), left),
+                                 constantLabel(Type('WORD'), right))
+
+    gen = generator.Generator(True)
+    if not gen.generate_exp_constant(func, expression):
+      return None
+    return [line.instruction for line in gen.buffer]
+
+  def test_multiply_by_either_constant(self):
+    # 32767 takes too long a sequence, so 3 is used on either side.
+    self.assertEqual(self.multiply(32767, 3),
+                     ['LDA', 'CLE', 'CIL', 'ADD'])
+    self.assertEqual(self.multiply(3, 32767), self.multiply(32767, 3))
+    self.assertEqual(self.multiply(32767, 32767), None)
+
+  def test_longest_multiply(self):
+    # 1023 is the longest run of ones that fits in MAX_MULTIPLY.
+    self.assertEqual(len(self.multiply(1023, 1023)), 28)
+    self.assertEqual(self.multiply(2047, 2047), None)
+    self.assertEqual(self.multiply(-32768, -32768), None)
+
+
+SWEEP = '''FUNC main() RETURNS NONE:
+  VARS:
+    WORD x
+    WORD y
+    WORD more
+  CODE:
+    x = -5
+    loop:
+      y = x * %(k)s
+      PRINT y
+      PRINT " "
+      y = %(k)s * x
+      PRINT y
+%(divide)s      PRINT
+      x = x + 3
+      more = x < 6
+      more ? GOTO loop
+END
+'''
+
+DIVIDE = '''      PRINT " "
+      y = x / %(k)s
+      PRINT y
+      PRINT " "
+      y = x %% %(k)s
+      PRINT y
+'''
+
+CONSTANTS = [0, 1, -1, 2, -2, 16384, -16384, -32768, 3, 7, -7, 1023, -1023,
+             2047, -2047, 32767]
+
+
+class ConstantSweepTest(unittest.TestCase):
+  def test_constants(self):
+    # Each constant on either side of *, and on the right of / and %, at
+    # every optimization level.
+    for value in CONSTANTS:
+      literal = '0x%04x' % (value & 0xffff)
+      divide = DIVIDE % {'k': literal} if value else ''
+      (machine, differ) = interpreter.compare(SWEEP % {'k': literal,
+                                                        'divide': divide})
+      self.assertTrue(machine.halted, value)
+      self.assertEqual(differ, [], '%d differs at %s' % (value, differ))
+
+
+
+CALLS = '''FUNC main() RETURNS NONE:
+  VARS:
+    WORD i
+    WORD r
+    WORD more
+  CODE:
+    i = 0
+    loop:
+      r = even(i)
+      PRINT r
+      PRINT " "
+      r = sumsq(i, 3)
+      PRINT r
+      PRINT
+      i = i + 1
+      more = i < 6
+      more ? GOTO loop
+END
+
+FUNC even(WORD n) RETURNS WORD:
+  VARS:
+    WORD test
+    WORD m
+    WORD r
+    WORD s
+  CODE:
+    test = n == 0
+    test ? RETURN n
+    m = n - 1
+    r = odd(m)
+    s = square(n)
+    r = r + s
+    RETURN r
+END
+
+FUNC odd(WORD n) RETURNS WORD:
+  VARS:
+    WORD test
+    WORD m
+    WORD r
+  CODE:
+    test = n == 0
+    test ? RETURN n
+    m = n - 1
+    r = even(m)
+    r = r * 2
+    RETURN r
+END
+
+FUNC sumsq(WORD a, WORD b) RETURNS WORD:
+  VARS:
+    WORD x
+    WORD y
+  CODE:
+    x = square(a)
+    y = square(b)
+    x = x - y
+    RETURN x
+END
+
+FUNC square(WORD x) RETURNS WORD:
+  VARS:
+    WORD y
+  CODE:
+    y = x * x
+    RETURN y
+END
+'''
+
+
+class DirectCallTest(unittest.TestCase):
+  def test_mutual_recursion(self):
+    # even and odd call each other, so they go through the stack, while the
+    # direct sumsq calls the direct square twice, and so do the recursive
+    # functions.
+    calls = analyser.call_graph(mparser.parse_program(CALLS))
+    self.assertEqual(analyser.direct_functions(calls),
+                     set(['sumsq', 'square']))
+
+    (machine, differ) = interpreter.compare(CALLS)
+    self.assertTrue(machine.halted)
+    # Recursive calls share the variables of the function, so even(2) squares
+    # the n that even(0), called through odd, left behind.
+    self.assertEqual(''.join(machine.output),
+                     '0 -9\n1 -8\n0 -5\n3 0\n0 7\n7 16\n')
+    self.assertEqual(differ, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
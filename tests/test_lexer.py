@@ -0,0 +1,51 @@
+import os
+import unittest
+import benchmark
+import misc
+
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'resources')
+# Lines the two tokenizers must split alike.
+EDGE_CASES = [
+  r'PRINT "a \"quoted\" word"',
+  r"PRINT 'it\'s \\ here'",
+  r'PRINT "tab\tand # not a comment"',
+  '# A comment on its own line',
+  'x = y + 1  # and one after code',
+  'x = -1',
+  'x = -32768',
+  'x = y - -7',
+  'x = 0x7FFF',
+  'x = 0xffff & y',
+  'x = 0XaB',
+  'x = y<<2',
+  'x = y>>z',
+  'x = y<=z',
+  'x = y != -0x10',
+  'arr[0] = ~y',
+  'ok ? GOTO loop',
+  'FUNC f(ARRAY[5] a, WORD b) RETURNS WORD:',
+]
+
+
+class LexerTest(unittest.TestCase):
+  def assertSameTokens(self, text):
+    self.assertEqual(benchmark.drain(misc.tokenizer(text)),
+                     benchmark.drain(benchmark.legacy_tokenizer(text)))
+
+  def test_resources(self):
+    for filename in ('example.txt', 'arith.txt'):
+      with open(os.path.join(RESOURCES, filename)) as source:
+        self.assertSameTokens(source.read())
+
+  def test_edge_cases(self):
+    for line in EDGE_CASES:
+      self.assertSameTokens(line + '\n')
+
+  def test_blank_lines(self):
+    self.assertSameTokens('\n  \nx = 1\n\n\ny = 2\n  \n')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import peephole
+from generator import AsmLine
+
+
+def parse(text):
+  # AsmLines from lines of 'label, INSTRUCTION target I'.
+  lines = []
+  for line in text.strip().split('\n'):
+    label = None
+    if ',' in line:
+      (label, line) = [i.strip() for i in line.split(',', 1)]
+    parts = line.split()
+    target = parts[1] if len(parts) > 1 else None
+    lines.append(AsmLine(label, parts[0], target, len(parts) > 2, None))
+  return lines
+
+
+def format(lines):
+  out = []
+  for line in lines:
+    parts = [line.instruction]
+    if line.target is not None:
+      parts.append(line.target)
+    if line.indirect:
+      parts.append('I')
+    out.append(('%s, ' % line.label if line.label else '') + ' '.join(parts))
+  return '\n'.join(out)
+
+
+class PeepholeTest(unittest.TestCase):
+  def assertRewrite(self, before, after, hits=(), removable=()):
+    # Optimizes before and checks that it becomes after, applying exactly the
+    # rules in hits.
+    counts = {}
+    result = peephole.optimize(parse(before), set(removable), counts)
+    self.assertEqual(format(result), format(parse(after)))
+    self.assertEqual(sorted(counts), sorted(hits))
+
+  def assertKept(self, text, removable=()):
+    self.assertRewrite(text, text, (), removable)
+
+  def test_nop(self):
+    self.assertRewrite('LDA x\nNOP\nSTA y', 'LDA x\nSTA y', ['nop'])
+    # The label moves to the next line.
+    self.assertRewrite('a, NOP\nSTA y', 'a, STA y', ['nop'])
+
+  def test_push_pop(self):
+    self.assertRewrite('LDA x\nBSA push\nBSA pop\nSTA y', 'LDA x\nSTA y',
+                       ['push-pop'])
+    self.assertKept('BSA push\na, BSA pop')
+
+  def test_store_load(self):
+    self.assertRewrite('STA x\nLDA x', 'STA x', ['store-load'])
+    self.assertKept('STA x\nLDA x I')
+    self.assertKept('STA x\na, LDA x')
+    self.assertKept('SZA\nSTA x\nLDA x')
+
+  def test_load_store(self):
+    self.assertRewrite('LDA x\nSTA x', 'LDA x', ['load-store'])
+    self.assertKept('LDA x\nSTA x I')
+    self.assertKept('LDA x\na, STA x')
+    self.assertKept('SNA\nLDA x\nSTA x')
+
+  def test_store_store(self):
+    self.assertRewrite('STA x\nSTA x', 'STA x', ['store-store'])
+    self.assertKept('STA x\nSTA y')
+    self.assertKept('STA x\na, STA x')
+    self.assertKept('ISZ c\nSTA x\nSTA x')
+
+  def test_dead_load(self):
+    self.assertRewrite('LDA x\nLDA y', 'LDA y', ['dead-load'])
+    self.assertRewrite('CLA\nLDA y', 'LDA y', ['dead-load'])
+    # Jumps to the label still load y.
+    self.assertRewrite('a, LDA x\nLDA y', 'a, LDA y', ['dead-load'])
+    # Which load takes effect depends on the skip.
+    self.assertKept('SZA\nLDA x\nLDA y')
+
+  def test_spill(self):
+    self.assertRewrite('BSA push\nLDA y\nADD z\nBSA pop',
+                       'STA temp3\nLDA y\nADD z\nLDA temp3', ['spill'])
+    # Calls may use the stack or temp3 themselves.
+    self.assertKept('BSA push\nLDA y\nBSA mul\nBSA pop')
+    self.assertKept('BSA push\nLDA y\na, ADD z\nBSA pop')
+    self.assertKept('SZA\nBSA push\nLDA y\nBSA pop')
+
+  def test_thread(self):
+    self.assertRewrite('BUN a\nc, LDA x\na, BUN b\nb, HLT',
+                       'BUN b\nc, LDA x\na, BUN b\nb, HLT', ['thread'])
+    # A skipped jump goes to the same place sooner.
+    self.assertRewrite('SZA\nBUN a\nc, LDA x\na, BUN b\nb, HLT',
+                       'SZA\nBUN b\nc, LDA x\na, BUN b\nb, HLT', ['thread'])
+    # A jump to itself has nowhere to go.
+    self.assertKept('BUN a\nc, HLT\na, BUN a')
+
+  def test_jump_next(self):
+    self.assertRewrite('LDA x\nBUN a\na, STA y', 'LDA x\na, STA y',
+                       ['jump-next'])
+    # Without the jump, the skip would skip the next line instead.
+    self.assertKept('SZA\nBUN a\na, STA y')
+
+  def test_unreachable(self):
+    self.assertRewrite('BUN a\nLDA x\nSTA y\nb, HLT\na, HLT',
+                       'BUN a\nb, HLT\na, HLT', ['unreachable'])
+    self.assertKept('HLT\nDEC 5')
+    self.assertKept('HLT\nb, LDA x')
+
+  def test_dead_label(self):
+    self.assertRewrite('a, LDA x\nSTA y', 'LDA x\nSTA y', ['dead-label'], 'a')
+    self.assertKept('a, LDA x\nSTA y')
+    self.assertKept('a, LDA x\nSZA\nBUN a', 'a')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,150 @@
+import os
+import unittest
+import compiler
+import runtime
+import simulator
+
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'resources', 'example.txt')
+
+EDGES = [0, 1, -1, 3, -7, -32768, 32767]
+
+ROUTINES = '''FUNC main() RETURNS NONE:
+  VARS:
+    ARRAY[%(count)d] edges
+    WORD a
+    WORD b
+    WORD i
+    WORD j
+    WORD y
+    WORD more
+  CODE:
+%(edges)s
+    i = 0
+    rows:
+      j = 0
+      columns:
+        a = edges[i]
+        b = edges[j]
+        y = a * b
+        PRINT y
+        PRINT " "
+        y = a / b
+        PRINT y
+        PRINT " "
+        y = a %% b
+        PRINT y
+        PRINT
+        j = j + 1
+        more = j < %(count)d
+        more ? GOTO columns
+      i = i + 1
+      more = i < %(count)d
+      more ? GOTO rows
+    PRINT edges
+END
+'''
+
+
+def word(value):
+  # The signed value of the low 16 bits of value.
+  value &= 0xffff
+  return value - 0x10000 if value & 0x8000 else value
+
+
+def divide(left, right):
+  # Truncates towards zero; division by 0 gives 0.
+  if not right:
+    return 0
+  quotient = abs(left) // abs(right)
+  return word(-quotient if (left < 0) != (right < 0) else quotient)
+
+
+def modulo(left, right):
+  # Of the absolute values; division by 0 gives 0.
+  return word(abs(left) % abs(right)) if right else 0
+
+
+class LibraryTest(unittest.TestCase):
+  def run_source(self, text):
+    with open(runtime.LIBRARY) as library:
+      sources = [(runtime.LIBRARY, library.read())]
+    sources.append(('program', compiler.Compiler().compile_source(text)))
+    machine = simulator.run(sources, 10 ** 7)[0]
+    self.assertTrue(machine.halted)
+    return ''.join(machine.output)
+
+  def test_edge_operands(self):
+    # mul, div (and udiv under it) and mod on every pair of edge values, read
+    # from an array so none is a constant, printed by outdec, and
+    # the values themselves printed by outarr.
+    expected = []
+    for left in EDGES:
+      for right in EDGES:
+        expected.append('%d %d %d\n' % (word(left * right),
+                                         divide(left, right),
+                                         modulo(left, right)))
+    # outarr follows every word with a space.
+    expected.append(''.join('%d ' % value for value in EDGES) + '\n')
+
+    edges = ['    edges[%d] = 0x%04x' % (i, value & 0xffff)
+             for (i, value) in enumerate(EDGES)]
+    output = self.run_source(ROUTINES % {'count': len(EDGES),
+                                         'edges': '\n'.join(edges)})
+    self.assertEqual(output.split('\n'), ''.join(expected).split('\n'))
+
+
+class LinkTest(unittest.TestCase):
+  def test_example(self):
+    # The linked program runs on its own, and prints what it prints after
+    # the whole library.
+    with open(runtime.LIBRARY) as library:
+      library = (runtime.LIBRARY, library.read())
+    with open(EXAMPLE) as source:
+      text = source.read()
+
+    for optimize in (False, True):
+      program = compiler.Compiler(optimize).compile_source(text)
+      (linked, saved) = runtime.link(program.split('\n'))
+      self.assertTrue(saved > 0)
+
+      names = set(runtime.parse_line(i)[0] for i in linked.split('\n'))
+      # outdec divides by the powers of ten in pw10 with udiv; the shifts
+      # are not used.
+      for name in ('outdec', 'pw10', 'udiv', 'push', 'call'):
+        self.assertTrue(name in names, name)
+      for name in ('shftl', 'shftr', 'cshftl'):
+        self.assertFalse(name in names, name)
+
+      # The stack starts right after the program, below the library.
+      positions = {}
+      (memory, symbols) = simulator.assemble(
+          [('program', program + linked)], positions)
+      lines = program.count('\n')
+      end = max(i for i in positions if positions[i][1] <= lines)
+      # stkdef is only kept with clear, which nothing calls here.
+      self.assertTrue('stkptr' in symbols)
+      for name in runtime.STACK:
+        if name in symbols:
+          self.assertEqual(memory[symbols[name]], end + 1)
+      self.assertTrue(end < min(symbols[i] for i in names if i))
+
+      expected = simulator.run([library, ('program', program)])[0]
+      machine = simulator.run([('program', program + linked)])[0]
+      self.assertTrue(machine.halted)
+      self.assertEqual(''.join(machine.output), ''.join(expected.output))
+
+  def test_stack(self):
+    # clear resets stkptr to stkdef, so both are kept, and both start the
+    # stack after the two words of the program.
+    program = ['ORG 0', 'BSA clear', 'HLT']
+    (linked, saved) = runtime.link(program)
+    (memory, symbols) = simulator.assemble(
+        [('program', '\n'.join(program) + linked)])
+    for name in runtime.STACK:
+      self.assertEqual(memory[symbols[name]], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,14 @@
+import unittest
+import simulator
+
+
+class MachineTest(unittest.TestCase):
+  def test_halt_after_skip(self):
+    # CLE, SZE and HLT in one word skip, then halt.
+    machine = simulator.Machine([0x7403, 0x7001, 0x7001] + [0] * 4093)
+    self.assertTrue(machine.run(10))
+    self.assertEqual((machine.steps, machine.pc, machine.e), (1, 2, 0))
+
+
+if __name__ == '__main__':
+  unittest.main()